@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+#########################################################################
+#
+#   Copyright 2009 David Liang
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#########################################################################
+
+import sys, os, time
+import json, shutil, subprocess, tempfile
+from os import path
+
+__doc__ = """
+Time rename.py on synthetic directories of files and print the results as
+JSON, with one entry per run, so that they can be compared between versions.
+Each run is timed in a fresh directory, created on tmpfs where possible."""
+
+SCENARIOS = {}
+
+def scenario(func):
+    SCENARIOS[func.__name__] = func
+    return func
+
+# Each scenario is given a number of files and returns the program to run
+# ("rename.py" or "renumb.py"), its arguments, the names of the files to
+# create and rename, in order (a name ending in "/" is a directory), and what
+# to send to its standard input. A scenario whose renames are all meant to be
+# rolled back has rollback set, and its rate is of the moves undone.
+
+@scenario
+def number(n):
+    names = ['f%07d.dat' % i for i in range(n)]
+    return 'renumb.py', ['-s', 'n{N}'], names, None
+
+@scenario
+def reversal(n):
+    names = ['%d.dat' % i for i in range(1, n+1)]
+    return 'renumb.py', [], names[::-1], None
+
+@scenario
+def shift(n):
+    names = ['%d.dat' % i for i in range(1, n+1)]
+    return 'renumb.py', ['-i', '2'], names, None
+
+@scenario
+def transform(n):
+    names = ['Photo %d - Holiday (copy).JPG' % i for i in range(n)]
+    return 'rename.py', ['-l', '-e', r's/\s*\(copy\)$//; s/ - /_/g',
+                         '-e', r's/(\d+)/#\1/; y/A-Z /a-z_/',
+                         '-e', 'y/a-z_#0-9//cd; y/a-z//s'], names, None
+
+@scenario
+def stdin(n):
+    names = ['in%d' % i for i in range(n)]
+    dests = ''.join('out%d\n' % (n - i) for i in range(n))
+    return 'rename.py', ['-r'], names, dests
+
+@scenario
+def rollback(n):
+    # one cycle through all the files, whose last link moves a directory into
+    # itself and fails, once every other file has been moved
+    names = ['%d.dat' % i for i in range(1, n-1)]
+    names = names[:1] + ['d/', 'd/y'] + names[1:]
+    dests = ''.join(name.rstrip('/') + '\n' for name in names[1:] + names[:1])
+    return 'rename.py', ['-r'], names, dests
+rollback.rollback = True
+
+
+def makeFiles(names):
+    for name in names:
+        if name.endswith('/'):
+            os.mkdir(name)
+            continue
+        os.close(os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+
+def straceCounts(cmd, stdin):
+    """Run cmd under strace -c and return its syscall counts by name."""
+    with tempfile.NamedTemporaryFile('r') as out:
+        subprocess.run(['strace', '-f', '-c', '-o', out.name] + cmd,
+                       stdin=stdin, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        counts = {}
+        for line in out:
+            fields = line.split()
+            if len(fields) >= 5 and fields[3].isdigit():
+                counts[fields[-1]] = int(fields[3])
+        return counts
+
+def runScenario(name, n, opts):
+    """Run a scenario on n files in a new directory, and return its results.
+    The files to rename are passed in a list with --from-file, so any number
+    of them can be given."""
+    workdir = tempfile.mkdtemp(prefix='bench-rename.', dir=opts.dir)
+    try:
+        tree = path.join(workdir, 'tree')
+        os.mkdir(tree)
+        os.chdir(tree)
+        prog, args, names, stdin = SCENARIOS[name](n)
+        makeFiles(names)
+        with open(path.join(workdir, 'files'), 'wb') as file:
+            file.write(b''.join(os.fsencode(name.rstrip('/')) + b'\0'
+                                for name in names))
+        with open(path.join(workdir, 'stdin'), 'w') as file:
+            file.write(stdin or '')
+
+        cmd = [sys.executable, path.join(opts.bindir, prog), '--stats-json',
+               '-0',
+               '--from-file', path.join(workdir, 'files')] + args
+        with open(path.join(workdir, 'stdin')) as infile, \
+             tempfile.TemporaryFile('w+') as errfile:
+            start = time.perf_counter()
+            proc = subprocess.Popen(cmd, stdin=infile,
+                                    stdout=subprocess.DEVNULL, stderr=errfile)
+            # wait4 rather than Popen.wait, for this child's own peak RSS
+            pid, status, usage = os.wait4(proc.pid, 0)
+            wall = time.perf_counter() - start
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            errfile.seek(0)
+            err = errfile.read()
+
+        stats = {'counters': {}, 'times': {}}
+        errors = []
+        for line in err.splitlines():
+            if line.startswith('{'):
+                stats = json.loads(line)
+            else:
+                errors.append(line)
+        renamed = stats['counters'].get('renamed', 0)
+        if getattr(SCENARIOS[name], 'rollback', False):
+            # the rename of each file is reported as rolled back, so only the
+            # outcome is checked
+            errors = []
+            undone = stats['counters'].get('rolled back', 0)
+            if stats['counters'].get('rollbacks') != 1 or renamed or not undone:
+                errors.append("%d files renamed, %d moves rolled back"
+                              % (renamed, undone))
+            renamed = undone
+        elif proc.returncode != 0 or renamed != n:
+            errors.append("exit status %d, %d of %d files renamed"
+                          % (proc.returncode, renamed, n))
+
+        result = {
+            'scenario': name,
+            'files': n,
+            'wall': round(wall, 4),
+            'renames_per_sec': round(renamed / wall, 1) if wall else None,
+            'user': round(usage.ru_utime, 4),
+            'sys': round(usage.ru_stime, 4),
+            'max_rss_kb': usage.ru_maxrss,
+            'counters': stats['counters'],
+            'phases': stats['times'],
+            'syscalls': None,
+            'errors': errors,
+        }
+
+        if opts.syscalls:
+            # strace slows the run down, so the counts come from a second run
+            # on a fresh copy of the files
+            shutil.rmtree(tree)
+            os.mkdir(tree)
+            os.chdir(tree)
+            makeFiles(names)
+            with open(path.join(workdir, 'stdin')) as infile:
+                result['syscalls'] = straceCounts(cmd, infile)
+        return result
+    finally:
+        os.chdir(opts.cwd)
+        shutil.rmtree(workdir)
+
+# Modules that rename.py only needs for some options, and so shouldn't be
+# importing up front; startup time matters under find -exec
+LAZY_MODULES = ('optparse', 'ctypes', 'random', 'json', 'mmap', 'fnmatch',
+                'multiprocessing', 'contextlib', 'threading', 'cProfile',
+                'pstats', 'fcntl', 'shutil', 'hashlib', 'concurrent.futures')
+
+def startup(opts):
+    """Time the import of rename.py, and check that it leaves the modules in
+    LAZY_MODULES alone; then time the startup of a run renaming nothing."""
+    env = dict(os.environ, PYTHONPATH=opts.bindir)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                           'import rename'], env=env, capture_output=True,
+                          text=True)
+    modules = {}
+    for line in proc.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            modules[fields[2].strip()] = int(fields[1])
+    errors = ["%s is imported by rename" % name
+              for name in LAZY_MODULES if name in modules]
+    if proc.returncode != 0:
+        errors.append(proc.stderr.strip().splitlines()[-1])
+
+    workdir = tempfile.mkdtemp(prefix='bench-rename.', dir=opts.dir)
+    try:
+        makeFiles([path.join(workdir, 'a')])
+        cmd = [sys.executable, path.join(opts.bindir, 'rename.py'), '-n',
+               path.join(workdir, 'a')]
+        best = None
+        for i in range(20):
+            start = time.perf_counter()
+            subprocess.run(cmd, stdout=subprocess.DEVNULL)
+            wall = time.perf_counter() - start
+            best = wall if best is None else min(best, wall)
+    finally:
+        shutil.rmtree(workdir)
+
+    return {
+        'import_us': modules.get('rename'),
+        'modules': sorted(modules),
+        'run': round(best, 4),
+        'errors': errors,
+    }
+
+def tmpfsDir():
+    """A directory on tmpfs to work in, if there is one."""
+    try:
+        with open('/proc/mounts') as mounts:
+            for line in mounts:
+                fields = line.split()
+                if fields[2] == 'tmpfs' and fields[1] in ('/dev/shm', '/tmp') \
+                   and os.access(fields[1], os.W_OK):
+                    return fields[1]
+    except OSError:
+        pass
+    return None
+
+def parseOptions(argv):
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [-s SCENARIO]... [-n N]... [OPTION]...",
+                          description=__doc__.strip())
+    parser.add_option("-s", "--scenario", metavar="SCENARIO", default=[],
+                      action="append", type="choice",
+                      choices=sorted(SCENARIOS),
+                      help='run SCENARIO, one of ' + ', '.join(SCENARIOS) +
+                           '; may be given more than once (default is all)')
+    parser.add_option("-n", "--files", metavar="N", default=[], type="int",
+                      action="append",
+                      help='number of files to run each scenario on; may be '
+                           'given more than once (default is 1000 and 10000)')
+    parser.add_option("-r", "--repeat", metavar="N", default=1, type="int",
+                      help='run each scenario N times (default is %default)')
+    parser.add_option("-d", "--dir", metavar="DIR", default=tmpfsDir(),
+                      help='create the files under DIR (default is %default)')
+    parser.add_option("--syscalls", default=False, action="store_true",
+                      help='also count system calls with strace(1), in a '
+                           'separate run')
+    parser.add_option("-o", "--output", metavar="FILE",
+                      help='write the results to FILE instead of standard '
+                           'output')
+    opts, args = parser.parse_args(argv[1:])
+    if args:
+        parser.error("unexpected arguments")
+    if opts.syscalls and not shutil.which('strace'):
+        parser.error("--syscalls needs strace")
+    opts.scenario = opts.scenario or list(SCENARIOS)
+    opts.files = opts.files or [1000, 10000]
+    opts.bindir = path.dirname(path.abspath(__file__))
+    opts.cwd = os.getcwd()
+    return opts
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    opts = parseOptions(argv)
+
+    start = startup(opts)
+    print('startup    import %6s us, run %.3fs' %
+          (start['import_us'], start['run']), file=sys.stderr)
+    for error in start['errors']:
+        print('  ' + error, file=sys.stderr)
+
+    results = []
+    for n in opts.files:
+        for name in opts.scenario:
+            for i in range(opts.repeat):
+                result = runScenario(name, n, opts)
+                results.append(result)
+                print('%-10s %8d files %9.3fs %12s renames/s %8d KB' %
+                      (name, n, result['wall'], result['renames_per_sec'],
+                       result['max_rss_kb']), file=sys.stderr)
+                for error in result['errors']:
+                    print('  ' + error, file=sys.stderr)
+
+    output = {
+        'python': sys.version.split()[0],
+        'version': subprocess.run([sys.executable,
+                                   path.join(opts.bindir, 'rename.py'),
+                                   '--version'], capture_output=True,
+                                  text=True).stdout.strip(),
+        'startup': start,
+        'results': results,
+    }
+    if opts.output:
+        with open(opts.output, 'w') as file:
+            json.dump(output, file, indent=1)
+            file.write('\n')
+    else:
+        json.dump(output, sys.stdout, indent=1)
+        print()
+    return 1 if start['errors'] or \
+                any(result['errors'] for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -25,9 +25,11 @@
 #
 #########################################################################
 
-import sys, os, signal
-import re, random
+import sys, os, signal, time
+import re
+from _thread import allocate_lock as Lock, RLock
 from os import path
+from errno import EEXIST, EINVAL, EISDIR, ENOSYS, ENOTDIR, EXDEV, EOPNOTSUPP
 
 __version__ = "0.7"
 __doc__ = """
@@ -39,13 +41,15 @@ allowed. For example `%(__prog__)s 2.jpg 1.jpg' swaps the two file names, and
 (to "2.jpg" and "3.jpg" respectively) only if 3.jpg doesn't exist."""
 
 
-def PrintError(*args, sep=': ', end='\n', file=sys.stderr):
+def PrintError(*args, sep=': ', end='\n', file=None):
+    if file is None:
+        file = sys.stderr
     pargs = []
     for arg in args:
         if arg is not None and arg != '':
-            pargs.append(arg)
+            pargs.append(str(arg))
     if pargs:
-        print(*pargs, sep=sep, end=end, file=file)
+        file.write(sep.join(pargs) + end)
 
 
 class Exit(Exception):
@@ -72,21 +76,34 @@ def handler(signum, frame):
 class StringTransform:
 
     from codecs import decode
-    from collections import defaultdict
-
-    _re_alnum = re.compile(r'[A-Za-z0-9]')
-    _re_translit_range = re.compile(r'(.)-(.)', re.DOTALL)
-    _re_char_run = re.compile(r'(.)\1+', re.DOTALL)
 
     class ParseError(Exception):
         def __init__(self, *args):
             self.args = args
 
+    class TranslationChain(dict):
+        """Translation table that applies several tables in sequence. Entries
+        are worked out one character at a time, as str.translate asks for
+        them."""
+
+        def __init__(self, tables):
+            self.tables = tables
+
+        def __missing__(self, ordinal):
+            string = chr(ordinal)
+            for table in self.tables:
+                string = string.translate(table)
+            self[ordinal] = string
+            return string
+
+    cache_size = 1 << 16
+
     def __init__(self):
         self.clear()
 
     def clear(self):
         self.ops = []
+        self.func = None
 
     def addSubstitution(self, pat, sub, opts):
         invalid = re.search(r'[^aig\d]', opts)
@@ -110,42 +127,116 @@ class StringTransform:
 
         if pat or sub:
             self.ops.append((regex, sub, count))
-
+            self.func = None
+
+
+    class TransliterationTable(dict):
+        """Translation table for y///, kept as ranges of code points rather
+        than one entry per character. A character is looked up by binary
+        search the first time str.translate asks for it, and the result is
+        memoized, so the cost of a table grows with the number of ranges in
+        the expression and the characters actually seen.
+
+        The i-th character in chars maps to the i-th character in repl, or to
+        default past the end of repl; if repl is None, characters map to
+        themselves. Characters not in chars map to fallback if it is given."""
+
+        def __init__(self, chars, repl, default=None, fallback=None):
+            self.starts = []
+            self.pieces = []
+            covered = []
+            pos = 0
+            for start, end in chars:
+                for s, e in self.subtract(start, end, covered):
+                    self.pieces.append((s, e, pos + s - start))
+                covered.append((start, end))
+                pos += end - start + 1
+            self.pieces.sort()
+            self.starts = [piece[0] for piece in self.pieces]
+
+            self.repl = repl
+            self.repl_pos = []
+            pos = 0
+            for start, end in repl or ():
+                self.repl_pos.append(pos)
+                pos += end - start + 1
+            self.repl_len = pos
+            self.default = default
+            self.fallback = fallback
+
+        @staticmethod
+        def subtract(start, end, covered):
+            """The parts of [start, end] not in any of the covered ranges."""
+            parts = [(start, end)]
+            for cs, ce in covered:
+                rest = []
+                for s, e in parts:
+                    if ce < s or cs > e:
+                        rest.append((s, e))
+                        continue
+                    if s < cs:
+                        rest.append((s, cs - 1))
+                    if ce < e:
+                        rest.append((ce + 1, e))
+                parts = rest
+            return parts
+
+        def __missing__(self, ordinal):
+            from bisect import bisect_right
+            j = bisect_right(self.starts, ordinal) - 1
+            if j >= 0 and ordinal <= self.pieces[j][1]:
+                start, end, pos = self.pieces[j]
+                i = pos + ordinal - start
+                if self.repl is None:
+                    value = ordinal
+                elif i < self.repl_len:
+                    k = bisect_right(self.repl_pos, i) - 1
+                    value = self.repl[k][0] + i - self.repl_pos[k]
+                else:
+                    value = self.default
+            elif self.fallback is not None:
+                value = self.fallback
+            else:
+                value = ordinal
+            self[ordinal] = value
+            return value
 
     @classmethod
-    def ordinalsList(cls, str):
-        list = []
+    def ordinalRanges(cls, str):
+        ranges = []
         while str:
-            run = cls._re_translit_range.match(str)
+            run = re.match(r'(.)-(.)', str, re.DOTALL)
             if run:
                 start, end = (ord(c) for c in run.group(1, 2))
                 if start > end:
                     raise cls.ParseError(
                               "invalid range in transliteration operator",
                               run.group(0) )
-                while start <= end:
-                    list.append(start)
-                    start += 1
+                ranges.append((start, end))
                 str = str[3:]
             else:
-                list.append(ord(str[0]))
+                ranges.append((ord(str[0]),) * 2)
                 str = str[1:]
-        return list
+        return ranges
 
     @staticmethod
-    def complementList(ords, length):
-        list = []
-        ords = set(ords)
+    def complementRanges(ranges, length):
+        """The first length code points not in ranges, as ranges."""
+        complement = []
         i = 0
-        while len(list) < length:
-            if i not in ords:
-                list.append(i)
-            i += 1
-        return list
+        for start, end in sorted(ranges) + [(sys.maxunicode + 1,) * 2]:
+            if length <= 0:
+                break
+            if start > i:
+                n = min(start - i, length)
+                complement.append((i, i + n - 1))
+                length -= n
+            i = max(i, end + 1)
+        return complement
 
     @classmethod
     def squash(cls, string):
-        return cls._re_char_run.sub(r'\1', string)
+        return re.sub(r'(.)\1+', r'\1', string, flags=re.DOTALL)
 
 
     def addTransliteration(self, chars, repl, opts):
@@ -160,35 +251,28 @@ class StringTransform:
         except UnicodeDecodeError as e:
             raise self.ParseError( "'%s' codec can't decode position %d-%d"
                                    % (e.encoding, e.start, e.end), e.reason )
-        char_a = self.ordinalsList(chars)
-        repl_a = self.ordinalsList(repl)
+        char_r = self.ordinalRanges(chars)
+        repl_r = self.ordinalRanges(repl)
         if complm:
-            char_a = self.complementList(char_a, len(repl_a))
-
-        map = dict()
+            char_r = self.complementRanges(char_r, sum(e - s + 1
+                                                       for s, e in repl_r))
+        default = None
         if delete:
             default = ''
-            if complm:
-                map = self.defaultdict(lambda: default)
-        elif repl_a:
-            default = repl_a[-1]
-            if complm:
-                map = self.defaultdict(lambda: default)
+        elif repl_r:
+            default = repl_r[-1][1]
         else:
-            repl_a = char_a
+            repl_r = None
 
-        for i, c in enumerate(char_a):
-            if c in map: continue
-            try:
-                map[c] = repl_a[i]
-            except IndexError:
-                map[c] = default
+        map = self.TransliterationTable(char_r, repl_r, default,
+                                        default if complm else None)
 
         if not complm:
             if not chars:
                 return
             elif not squash:
                 self.ops.append(map)
+                self.func = None
                 return
         try:
             chars = chars.replace('[', r'\[').replace(']', r'\]')
@@ -207,6 +291,7 @@ class StringTransform:
             sub = lambda m: m.group().translate(map)
 
         self.ops.append((regex, sub, 0))
+        self.func = None
         return
 
 
@@ -226,7 +311,7 @@ class StringTransform:
             i = (2 if expr.startswith('tr') else 1)
             if not expr[i:]:
                 raise self.ParseError("unterminated expression", expr)
-            elif self._re_alnum.match(expr[i]):
+            elif re.match(r'[A-Za-z0-9]', expr[i]):
                 raise self.ParseError("invalid delimiter", expr)
 
             sep = (r'\\' if expr[i] == '\\' else expr[i])
@@ -244,30 +329,413 @@ class StringTransform:
             expr = expr[mat.end()+i:]
 
 
-    def transform(self, string):
+    def compile(self):
+        """Turn the list of operations into a single function, fusing runs of
+        plain transliterations into one translation table, and memoize its
+        results, since the same names tend to come up again and again.
+        Substitutions are kept apart, as each one sees the output of the last."""
+        from functools import lru_cache, partial
+        from operator import methodcaller
+
+        ops = []
         for op in self.ops:
+            if type(op) != tuple and ops and type(ops[-1]) == list:
+                ops[-1].append(op)
+            else:
+                ops.append([op] if type(op) != tuple else op)
+
+        funcs = []
+        for op in ops:
             if type(op) == tuple:
-                string = op[0].sub(op[1], string, op[2])
+                funcs.append(partial(op[0].sub, op[1], count=op[2]))
+            elif len(op) == 1:
+                funcs.append(methodcaller('translate', op[0]))
             else:
-                string = string.translate(op)
-        return string
+                funcs.append(methodcaller('translate',
+                                          self.TranslationChain(op)))
+
+        if not funcs:
+            self.func = lambda string: string
+            return
+        elif len(funcs) == 1:
+            func = funcs[0]
+        else:
+            def func(string):
+                for f in funcs:
+                    string = f(string)
+                return string
+        self.func = lru_cache(maxsize=self.cache_size)(func)
 
+    def transform(self, string):
+        if self.func is None:
+            self.compile()
+        return self.func(string)
 
-def shortPath(path):
-    return _re_home.sub('~', path)
+
+def shortPath(pathname):
+    home = path.expanduser('~')
+    if pathname.startswith(home):
+        return '~' + pathname[len(home):]
+    return pathname
 
 def tempSuffix():
-    return '.%s.%d.%s' % (__prog__, _pid, ''.join(random.sample(_letters, 4)))
+    from random import sample
+    return '.%s.%d.%s' % (__prog__, _pid, ''.join(sample(_letters, 4)))
+
+
+BATCH_SIZE = 10000
+
+_setup_lock = Lock()
+
+RENAME_NOREPLACE = 1
+RENAME_EXCHANGE = 2
+
+def loadRenameat2():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        func = ctypes.CDLL(None, use_errno=True).renameat2
+    except (ImportError, OSError, AttributeError):
+        return None
+    func.argtypes = (ctypes.c_int, ctypes.c_char_p,
+                     ctypes.c_int, ctypes.c_char_p, ctypes.c_uint)
+    func.restype = ctypes.c_int
+    return func
+
+def renameat2():
+    """The renameat2 function, loaded the first time it's asked for, or None
+    where it isn't available."""
+    global _renameat2
+    if _renameat2 is False:
+        _renameat2 = loadRenameat2()
+    return _renameat2
+
+class DirFds:
+    """Open directory fds for renameat2, kept for the `size' directories used
+    most recently. An fd is closed once it's neither cached nor in use by a
+    call on another thread. The fds of a directory and of everything under
+    it are dropped when it's renamed, since they would go on referring to it
+    by its old name. Each entry also keeps the device the directory is on."""
+
+    size = 64
+
+    def __init__(self):
+        from collections import OrderedDict
+        self.fds = OrderedDict()
+        self.under = {}
+        self.lock = Lock()
+
+    def acquire(self, dirname):
+        """An entry [fd, users, dropped, device] for dirname, to be given back
+        to release once the call using fd is made."""
+        with self.lock:
+            entry = self.fds.get(dirname)
+            if entry is not None:
+                self.fds.move_to_end(dirname)
+                entry[1] += 1
+                return entry
+        fd = os.open(dirname, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            addStat('stat calls')
+            device = os.fstat(fd).st_dev
+        except OSError:
+            os.close(fd)
+            raise
+        with self.lock:
+            entry = self.fds.get(dirname)
+            if entry is not None:
+                os.close(fd)
+            else:
+                entry = self.fds[dirname] = [fd, 0, False, device]
+                for parent in ancestors(dirname):
+                    self.under[parent] = self.under.get(parent, 0) + 1
+                while len(self.fds) > self.size:
+                    self.drop(*self.fds.popitem(last=False))
+            entry[1] += 1
+            return entry
+
+    def release(self, entry):
+        with self.lock:
+            entry[1] -= 1
+            if entry[2] and not entry[1]:
+                os.close(entry[0])
+
+    def drop(self, dirname, entry):
+        for parent in ancestors(dirname):
+            self.under[parent] -= 1
+            if not self.under[parent]:
+                del self.under[parent]
+        entry[2] = True
+        if not entry[1]:
+            os.close(entry[0])
+
+    def forget(self, pathname):
+        """Drop the fds of pathname and the directories under it."""
+        if pathname not in self.fds and pathname not in self.under:
+            return
+        prefix = path.join(pathname, '')
+        with self.lock:
+            for dirname in [dirname for dirname in self.fds
+                            if dirname == pathname or
+                               dirname.startswith(prefix)]:
+                self.drop(dirname, self.fds.pop(dirname))
+
+    def close(self):
+        with self.lock:
+            while self.fds:
+                self.drop(*self.fds.popitem())
+
+def ancestors(pathname):
+    parent = path.dirname(pathname)
+    while parent != pathname:
+        yield parent
+        pathname, parent = parent, path.dirname(parent)
+
+def closeDirFds():
+    _dirfds.close()
+
+def renameAt(src, dst, flags):
+    """Call renameat2(2) with flags, relative to cached directory fds. Raises
+    OSError on failure; ENOSYS also disables renameat2 for the rest of the
+    run. A file system that rejects the flags with EINVAL, as NFS does, has
+    its device remembered, and renames on it fail with EINVAL from then on
+    without another call, so that callers go straight to their fallbacks."""
+    global _renameat2
+    from ctypes import get_errno
+    src_dir, src_name = path.split(src)
+    dst_dir, dst_name = path.split(dst)
+    src_fd = _dirfds.acquire(src_dir)
+    try:
+        device = src_fd[3]
+        if device in _flagless_devices:
+            errno = EINVAL
+        else:
+            dst_fd = _dirfds.acquire(dst_dir)
+            try:
+                errno = 0
+                if renameat2()(src_fd[0], os.fsencode(src_name),
+                               dst_fd[0], os.fsencode(dst_name), flags) != 0:
+                    errno = get_errno()
+            finally:
+                _dirfds.release(dst_fd)
+    finally:
+        _dirfds.release(src_fd)
+    if errno:
+        if errno == ENOSYS:
+            _renameat2 = None
+        elif errno == EINVAL and flags and \
+             not path.join(dst, '').startswith(path.join(src, '')):
+            # not a directory moved under itself, so it was the flags
+            _flagless_devices.add(device)
+        raise OSError(errno, os.strerror(errno), src, None, dst)
+    _dirfds.forget(src)
+    _dirfds.forget(dst)
+
+def moveFile(src, dst, replace=False):
+    """Rename src to dst. Unless replace is true, an existing dst is left
+    alone and False is returned. RENAME_NOREPLACE makes the check atomic
+    where the kernel and file system support it; elsewhere dst is looked up
+    just before the rename, and never in the DirIndex, whose listing of a
+    directory may be out of date."""
+    if not replace and renameat2():
+        try:
+            renameAt(src, dst, RENAME_NOREPLACE)
+            _index.moved(src, dst)
+            return True
+        except OSError as e:
+            if e.errno == EEXIST:
+                _index.add(dst)
+                return False
+            elif e.errno == EXDEV:
+                return copyMove(src, dst, replace)
+            elif e.errno not in (ENOSYS, EINVAL):
+                raise
+    if not replace:
+        addStat('lexists calls')
+        if path.lexists(dst):
+            _index.add(dst)
+            return False
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != EXDEV:
+            raise
+        return copyMove(src, dst, replace)
+    _dirfds.forget(src)
+    _dirfds.forget(dst)
+    _index.moved(src, dst)
+    return True
+
+def copyMove(src, dst, replace=False):
+    """Move src to dst on another file system: copy it to a temporary name
+    next to dst, with its owner, permissions and times, rename that into
+    place with moveFile, and remove src. Only regular files and symbolic
+    links can be moved this way."""
+    import shutil, stat
+    info = os.lstat(src)
+    # not a name that --recover would put back, since the copy may be partial
+    temp = dst + tempSuffix() + '.part'
+    if stat.S_ISLNK(info.st_mode):
+        os.symlink(os.readlink(src), temp)
+    elif stat.S_ISREG(info.st_mode):
+        with open(src, 'rb') as fin, open(temp, 'xb') as fout:
+            try:
+                copyData(fin, fout, info.st_size, src)
+                os.fsync(fout.fileno())
+            except BaseException:
+                os.unlink(temp)
+                raise
+    else:
+        raise OSError(EXDEV, os.strerror(EXDEV), src, None, dst)
+
+    try:
+        try:
+            os.chown(temp, info.st_uid, info.st_gid, follow_symlinks=False)
+        except PermissionError:
+            pass
+        shutil.copystat(src, temp, follow_symlinks=False)
+        if not moveFile(temp, dst, replace):
+            return False
+        temp = None
+    finally:
+        if temp is not None:
+            os.unlink(temp)
+
+    try:
+        os.unlink(src)
+    except OSError:
+        os.unlink(dst)
+        _index.moved(dst, src)
+        raise
+    _index.moved(src, dst)
+    addStat('cross-device moves')
+    return True
+
+COPY_CHUNK = 1 << 23
+PROGRESS_SIZE = 1 << 28
+
+def copyData(fin, fout, size, name):
+    """Copy the contents of file fin to fout, inside the kernel with
+    copy_file_range or sendfile where the system allows, and otherwise
+    through a buffer. The progress of large copies is shown on a terminal."""
+    infd, outfd = fin.fileno(), fout.fileno()
+    show = size >= PROGRESS_SIZE and sys.stderr.isatty()
+    done = shown = 0
+
+    def progress(n):
+        nonlocal done, shown
+        done += n
+        addStat('bytes copied', n)
+        if show and done * 100 // size > shown:
+            shown = done * 100 // size
+            PrintError("\rcopying " + shortPath(name), "%d%%" % shown, end='')
+
+    try:
+        for method in ('copy_file_range', 'sendfile'):
+            if not hasattr(os, method):
+                continue
+            try:
+                while True:
+                    if method == 'copy_file_range':
+                        n = os.copy_file_range(infd, outfd, COPY_CHUNK)
+                    else:
+                        n = os.sendfile(outfd, infd, None, COPY_CHUNK)
+                    if not n:
+                        return
+                    progress(n)
+            except OSError as e:
+                if done or e.errno not in (EXDEV, ENOSYS, EINVAL, EOPNOTSUPP):
+                    raise
+        while True:
+            data = fin.read(1 << 20)
+            if not data:
+                return
+            fout.write(data)
+            progress(len(data))
+    finally:
+        if show and shown:
+            sys.stderr.write('\n')
+
+
+class DirIndex:
+    """Names in the directories touched by a run, so that existence checks
+    don't each cost a stat. A directory is read with a single scandir once
+    it has been looked up `threshold' times, and is kept current as files are
+    renamed; until then, and for directories that can't be read, lookups go
+    to path.lexists. Reading and updating are locked against each other, so
+    that a listing never misses a rename done on another thread."""
+
+    threshold = 8
+
+    def __init__(self):
+        self.names = {}
+        self.lookups = {}
+        self.lock = Lock()
+
+    def listing(self, dirname):
+        try:
+            return self.names[dirname]
+        except KeyError:
+            pass
+        count = self.lookups.get(dirname, 0) + 1
+        self.lookups[dirname] = count
+        if count < self.threshold:
+            return None
+        with self.lock:
+            if dirname in self.names:
+                return self.names[dirname]
+            try:
+                addStat('directory scans')
+                with os.scandir(dirname) as it:
+                    names = set(entry.name for entry in it)
+            except OSError:
+                names = None
+            self.names[dirname] = names
+        return names
+
+    def exists(self, pathname):
+        dirname, name = path.split(pathname)
+        names = self.listing(dirname)
+        if names is None:
+            addStat('lexists calls')
+            return path.lexists(pathname)
+        return name in names
+
+    def add(self, pathname):
+        dirname, name = path.split(pathname)
+        with self.lock:
+            names = self.names.get(dirname)
+            if names is not None:
+                names.add(name)
+
+    def moved(self, src, dst):
+        src_dir, src_name = path.split(src)
+        dst_dir, dst_name = path.split(dst)
+        with self.lock:
+            names = self.names.get(src_dir)
+            if names is not None:
+                names.discard(src_name)
+            names = self.names.get(dst_dir)
+            if names is not None:
+                names.add(dst_name)
 
 class Rename:
 
-    def __init__(self, arg, path, new_name, new_path):
+    __slots__ = ('arg', 'path', 'new_name', 'new_path', 'stat',
+                 'temp_path', 'hop', 'renamed', 'failed', 'error')
+
+    def __init__(self, arg, path, new_name, new_path, stat=None):
         self.arg = arg
         self.path = path
         self.new_name = new_name
         self.new_path = new_path
+        self.stat = stat
         self.temp_path = None
+        self.hop = False
         self.renamed = False
+        self.failed = False
+        self.error = None
 
     def __repr__(self):
         return "`%s' -> `%s'" % (self.arg, self.new_path)
@@ -275,84 +743,508 @@ class Rename:
     def __eq__(self, other):
         return self.path == other.path
 
-    def tempMove(self):
+    def fileStat(self):
+        """The stat result for the source, fetched at most once. Sources found
+        by walking a directory hold on to their DirEntry until it's needed."""
+        if isinstance(self.stat, os.DirEntry):
+            addStat('stat calls')
+            self.stat = self.stat.stat()
+        return self.stat
+
+    def fail(self, *reason, quiet=None):
+        """Mark the rename as failed, keeping the reason in error, and report
+        it unless quiet, which by default is as the engine state has it."""
+        self.failed = True
+        self.error = ': '.join(str(part) for part in reason if part)
+        if not (_quiet if quiet is None else quiet):
+            PrintError(self.arg + " not renamed", *reason)
+
+    def vacated(self):
+        return self.renamed or self.temp_path is not None
+
+    def tempMove(self, txn=None):
         if (self.path == self.new_path):
             return
-        while True:
-            self.temp_path = self.path + tempSuffix()
-            if not path.lexists(self.temp_path):
-                break
         try:
-            os.rename(self.arg, self.temp_path)
+            while True:
+                self.temp_path = self.path + tempSuffix()
+                if not _index.exists(self.temp_path) and \
+                   moveFile(self.path, self.temp_path):
+                    break
+                addStat('temp retries')
+            if txn: txn.record(self, self.path, self.temp_path)
         except OSError as e:
             self.temp_path = None
-            PrintError(self.arg, e.strerror)
+            self.failed = True
+            self.error = e.strerror
+            if not _quiet:
+                PrintError(self.arg, e.strerror)
             updateStatus(1)
 
-    def doRename(self):
-        if not self.temp_path or not path.lexists(self.temp_path):
+    def doRename(self, txn=None):
+        if self.failed or self.renamed or self.path == self.new_path:
             return
-        if path.lexists(self.new_path):
-            if not _force:
-                PrintError(self.arg + " not renamed",
-                           shortPath(self.new_path) + " exists")
-                self.tempRevert()
-                return
+        blocker = _sources.get(self.new_path)
+        src = self.temp_path or self.path
         try:
-            os.rename(self.temp_path, self.new_path)
-            _renamed[self.new_path] = self
+            if blocker is not None and not blocker.vacated() or \
+               not moveFile(src, self.new_path, _force):
+                self.fail(shortPath(self.new_path) + " exists")
+                return
+            if txn: txn.record(self, src, self.new_path)
+            addStat('renamed')
             self.renamed = True
         except OSError as e:
-            PrintError(self.arg + " not renamed",
-                       e.filename, e.strerror)
-            self.tempRevert()
+            self.fail(e.filename, e.strerror)
+
+    def exchange(self):
+        """Swap names with the other member of a 2-cycle in one syscall,
+        falling back to a temp hop where RENAME_EXCHANGE is unsupported."""
+        other = _sources[self.new_path]
+        if renameat2():
+            try:
+                renameAt(self.path, other.path, RENAME_EXCHANGE)
+                for rn in (self, other):
+                    addStat('renamed')
+                    rn.renamed = True
+                return
+            except OSError as e:
+                if e.errno not in (ENOSYS, EINVAL, EXDEV):
+                    for rn in (self, other):
+                        rn.fail(e.filename, e.strerror)
+                    return
+        addStat('temp hops')
+        rotateCycle([self, other])
+
+    def newArg(self):
+        """The new path, relative in the same way as arg if the file stays in
+        the same directory."""
+        if path.dirname(self.new_path) == path.dirname(self.path):
+            return path.join(path.dirname(self.arg.rstrip(os.sep)),
+                             self.new_name)
+        return self.new_path
 
-    def tempRevert(self):
-        if self.renamed or not self.temp_path or not path.lexists(self.temp_path):
+    def print(self):
+        if self.path == self.new_path:
             return
-        try:
-            if path.lexists(self.path):
-                if self.path not in _renamed or \
-                   not _renamed[self.path].undoRename():
-                    from errno import EEXIST
-                    raise OSError(EEXIST, "original location exists")
-            os.rename(self.temp_path, self.path)
-            self.temp_path = None
-        except OSError as e:
-            PrintError("could not revert " + shortPath(self.temp_path),
-                       e.filename, e.strerror)
-            updateStatus(4)
+        if _output.format == 'json':
+            # a rename that failed without a reason was only put off until
+            # the next batch, and will be printed from there
+            if self.renamed:
+                _output.add(self, 'renamed')
+            elif self.failed:
+                if self.error is not None:
+                    _output.add(self, 'failed')
+            else:
+                _output.add(self, 'planned' if _noact else 'not renamed')
+        elif self.renamed:
+            if _verbose or _output.format == 'print0':
+                _output.add(self)
+        elif _noact and not self.failed:
+            _output.add(self)
+
+
+class OutputWriter:
+    """Standard output for the list of renames, in one of three formats:
+    "text", a file and its new name separated by a tab on each line; "print0",
+    a file and its new path, each followed by a null character, as --map -0
+    reads them; or "json", an object on each line with the file's old and new
+    paths, status and error. Output is encoded as file names are, so any name
+    can be printed, and written out in large pieces."""
+
+    def __init__(self, format='text'):
+        self.format = format
+        self.chunks = []
+        self.size = 0
+        if format == 'json':
+            import json
+            self.encoder = json.JSONEncoder()
+
+    def add(self, rn, status=None):
+        if self.format == 'json':
+            line = self.encoder.encode({
+                'old': rn.arg, 'new': rn.newArg(),
+                'status': status, 'error': rn.error,
+            }).encode() + b'\n'
+        elif self.format == 'print0':
+            line = os.fsencode(rn.arg) + b'\0' + os.fsencode(rn.newArg()) + b'\0'
+        else:
+            line = os.fsencode(rn.arg) + b':\t' + os.fsencode(rn.new_name) + b'\n'
+        self.chunks.append(line)
+        self.size += len(line)
+        if self.size >= 1 << 16:
+            self.flush()
+
+    def flush(self):
+        if self.chunks:
+            sys.stdout.flush()
+            sys.stdout.buffer.write(b''.join(self.chunks))
+            self.chunks = []
+            self.size = 0
+        sys.stdout.flush()
+
+
+def rotateCycle(cycle):
+    """Rename each member of cycle to the source of the one after it, moving
+    the first member to a temporary name to make room. The moves are undone
+    if any of them fails."""
+    txn = Transaction()
+    head = cycle[0]
+    head.tempMove(txn)
+    for rn in reversed(cycle[1:]):
+        rn.doRename(txn)
+    head.doRename(txn)
+    if any(rn.failed for rn in cycle):
+        txn.rollback()
+    else:
+        txn.close()
 
-    def undoRename(self):
-        if not self.renamed or not path.lexists(self.new_path):
-            return False
-        if path.lexists(self.path):
-            if self.path not in _renamed or not _renamed[self.path].undoRename():
-                return False
-        try:
-            os.rename(self.new_path, self.path)
-            PrintError(self.arg + " not renamed",
-                       shortPath(self.new_path) + " exists")
-            self.renamed = False
-            return True
-        except OSError as e:
-            return False
 
-    def print(self):
-        if self.renamed:
-            if _verbose:
-                print(self.arg, self.new_name, sep=':\t')
-        elif _noact:
+class Transaction:
+    """A record of completed moves, in order, that can be undone. Open
+    transactions are rolled back if the program is interrupted."""
+
+    def __init__(self):
+        self.moves = []
+        _transactions.append(self)
+
+    def record(self, rn, src, dst):
+        self.moves.append((rn, src, dst))
+
+    def close(self):
+        self.moves = []
+        if self in _transactions:
+            _transactions.remove(self)
+
+    def rollback(self):
+        """Undo the recorded moves, last first."""
+        if self.moves:
+            addStat('rollbacks')
+        while self.moves:
+            rn, src, dst = self.moves.pop()
             try:
-                os.stat(self.arg)
-                if self.path != self.new_path:
-                    print(self.arg, self.new_name, sep=':\t')
+                if not moveFile(dst, src):
+                    raise OSError(EEXIST, "original location exists", src)
             except OSError as e:
-                PrintError(self.arg, e.strerror)
-                updateStatus(1)
+                rn.error = "could not revert: " + e.strerror
+                if not _quiet:
+                    PrintError("could not revert " + shortPath(dst),
+                               e.filename, e.strerror)
+                updateStatus(4)
+                continue
+            addStat('rolled back')
+            if dst == rn.temp_path:
+                rn.temp_path = None
+            else:
+                rn.fail("rolled back")
+                addStat('renamed', -1)
+                rn.renamed = False
+        self.close()
+
+
+class Journal:
+    """An append-only record of the renames in each batch, written and synced
+    before the batch is started so that it can be undone with --undo. Records
+    are a one-byte tag followed by null-terminated fields:
+
+        B id            a batch begins; its moves follow
+        M source dest   a move planned in the batch
+        F id N          move N (from 0) of batch id was not made
+        E id            batch id has ended
+        U id            batch id has been undone
+
+    Paths are absolute. A batch id is the process id, random hex digits
+    that tell apart runs given the same process id, and the batch's number
+    in the run. The beginning of a batch and its moves are written in one piece, as
+    are the failures and end of a batch, so that processes sharing a journal
+    don't garble each other's records."""
+
+    def __init__(self, filename):
+        self.fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                          0o666)
+        self.run = os.urandom(6).hex()
+        self.seq = 0
+
+    def write(self, fields):
+        data = b'\0'.join(os.fsencode(field) for field in fields) + b'\0'
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+
+    def begin(self, renames):
+        """Record a batch of renames before any of them are made. Returns the
+        batch id."""
+        self.seq += 1
+        batch = '%d.%s.%d' % (os.getpid(), self.run, self.seq)
+        fields = ['B' + batch]
+        for rn in renames:
+            fields.append('M' + rn.path)
+            fields.append(rn.new_path)
+        self.write(fields)
+        os.fsync(self.fd)
+        return batch
+
+    def end(self, batch, renames):
+        fields = []
+        for i, rn in enumerate(renames):
+            if not rn.renamed:
+                fields.append('F' + batch)
+                fields.append(str(i))
+        fields.append('E' + batch)
+        self.write(fields)
+
+    def undone(self, batch):
+        self.write(['U' + batch])
+
+    def close(self):
+        os.close(self.fd)
+
+def readJournal(file):
+    """Return the batches in a journal file, in order, as (id, moves, ended)
+    tuples, where moves are the (source, destination) pairs that were made or,
+    for a batch that never ended, may have been. Batches that have been undone
+    are left out."""
+    import mmap
+    try:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, ValueError, OSError):
+        data = file.read()
+
+    batches = {}
+    failed = {}
+    ended = set()
+    undone = set()
+    start = 0
+    current = None
+    while start < len(data):
+        offset = start
+        end = data.find(b'\0', start)
+        if end < 0:
+            raise Exit(1, file.name, "truncated journal")
+        tag, field = data[start:start+1], os.fsdecode(data[start+1:end])
+        start = end + 1
+        if tag == b'M' and current is not None:
+            end = data.find(b'\0', start)
+            if end < 0:
+                raise Exit(1, file.name, "truncated journal")
+            current.append((field, os.fsdecode(data[start:end])))
+            start = end + 1
+            continue
+        current = None
+        if tag == b'B':
+            if field in batches:
+                raise Exit(1, file.name, "batch %s begins twice (at byte %d)"
+                                         % (field, offset))
+            current = batches[field] = []
+        elif tag == b'F':
+            end = data.find(b'\0', start)
+            if end < 0:
+                raise Exit(1, file.name, "truncated journal")
+            try:
+                failed.setdefault(field, set()).add(int(data[start:end]))
+            except ValueError:
+                raise Exit(1, file.name, "not a journal (at byte %d)" % offset)
+            start = end + 1
+        elif tag == b'E' and field in batches:
+            ended.add(field)
+        elif tag == b'U' and field in batches:
+            undone.add(field)
+        else:
+            raise Exit(1, file.name, "not a journal (at byte %d)" % offset)
 
+    if isinstance(data, mmap.mmap):
+        data.close()
+    return [(batch, [move for i, move in enumerate(moves)
+                          if i not in failed.get(batch, ())],
+             batch in ended)
+            for batch, moves in batches.items() if batch not in undone]
 
-def nextRename(arg, abspath):
+def loadJournal(filename):
+    try:
+        file = open(filename, 'rb')
+    except OSError as e:
+        raise Exit(1, filename, e.strerror)
+    with file:
+        return readJournal(file)
+
+def movesInPlace(moves):
+    """The moves of a batch that was cut short that are found to have been
+    made. Chains are renamed from their free ends back, so a move in a chain
+    was made if its destination exists and its source is free, or is the
+    destination of a move that was made. The names in a cycle are all taken
+    whether or not it was renamed, so its moves are left out."""
+    by_src = {src: (src, dst) for src, dst in moves}
+    by_dest = {dst: (src, dst) for src, dst in moves}
+
+    cyclic = set()
+    seen = set()
+    for move in moves:
+        trail = {}
+        while move is not None and move not in seen:
+            seen.add(move)
+            trail[move] = len(trail)
+            move = by_src.get(move[1])
+        if move in trail:
+            cyclic.update(list(trail)[trail[move]:])
+
+    in_place = {}
+    for move in moves:
+        if move in cyclic:
+            in_place[move] = False
+            continue
+        chain = []
+        while move not in in_place:
+            chain.append(move)
+            src, dst = move
+            if not path.lexists(dst):
+                made = False
+            elif not path.lexists(src):
+                made = True
+            elif src in by_dest:
+                move = by_dest[src]
+                continue
+            else:
+                made = False
+            break
+        else:
+            made = in_place[move]
+        for link in chain:
+            in_place[link] = made
+    return [move for move in moves if in_place[move]]
+
+def undoJournal(filename):
+    """Undo the renames recorded in a journal, one batch at a time, last batch
+    first, recording each batch that is undone so that it isn't undone again,
+    and stopping at the first batch that can't be undone in full. Each batch
+    is reversed as a whole, so it goes through the same planning as any other
+    set of renames, cycles included. Moves that are found already undone are
+    skipped; of a batch that never ended, only the moves found in place are
+    undone (see movesInPlace), and its cycles are left for --recover."""
+    batches = loadJournal(filename)
+    journal = None
+    if not _noact:
+        try:
+            journal = Journal(filename)
+        except OSError as e:
+            raise Exit(1, filename, e.strerror)
+    try:
+        for batch, moves, ended in reversed(batches):
+            if ended:
+                moves = [(src, dst) for src, dst in moves
+                         if path.lexists(dst) or not path.lexists(src)]
+            else:
+                PrintError(shortPath(filename),
+                           "batch %s did not finish" % batch)
+                updateStatus(1)
+                moves = movesInPlace(moves)
+            renames = [Rename(dst, dst, path.basename(src), src)
+                       for src, dst in reversed(moves)]
+            processRenames(renames)
+            if journal is None:
+                continue
+            if not all(rn.renamed for rn in renames):
+                PrintError(shortPath(filename),
+                           "batch %s was not undone in full" % batch,
+                           "stopping")
+                updateStatus(1)
+                break
+            journal.undone(batch)
+    finally:
+        if journal is not None:
+            journal.close()
+
+def processAlive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def recoverRenames(args):
+    """Find the files left at temporary names in the directories among args
+    by runs that were killed before putting them back, and rename them in
+    one set per directory. A file goes back to its original name, unless a
+    --journal shows the cycle of renames it was taken out of, in which case
+    the cycle is completed. Files whose runs are still going are left alone,
+    as are files that only look like temporary names: a name counts if the
+    journal has a rename of its original, or if the original is missing."""
+    dests = {}
+    if _journal_file:
+        for batch, moves, ended in loadJournal(_journal_file):
+            # a temporary name outlives its run only if the run was killed
+            # before it could end the batch; a temporary name only gives the
+            # process id, so where two such runs had the same one, the later
+            # is taken
+            if ended:
+                continue
+            pid = batch.partition('.')[0]
+            for src, dst in moves:
+                dests[pid, src] = dst
+
+    # see tempSuffix
+    progs = sorted(set([__prog__, 'rename.py', 'renumb.py']))
+    re_temp = re.compile(r'^(?P<name>.+)\.(?:%s)\.(?P<pid>\d+)\.[%s]{4}$'
+                         % ('|'.join(map(re.escape, progs)), _letters), re.S)
+
+    def batches():
+        for arg in args:
+            if not path.isdir(arg):
+                PrintError(arg, "Not a directory")
+                updateStatus(1)
+            elif _recursive:
+                yield from walkTree(arg)
+            else:
+                entries = listDir(arg)
+                if entries is not None:
+                    yield entries
+
+    for entries in batches():
+        renames = []
+        for entry in entries:
+            match = re_temp.match(entry.name)
+            if not match:
+                continue
+            pid = match.group('pid')
+            if processAlive(int(pid)):
+                if _verbose:
+                    PrintError("skipping " + entry.path,
+                               "process %s is running" % pid)
+                continue
+            temp_path = path.abspath(entry.path)
+            src = path.join(path.dirname(temp_path), match.group('name'))
+            if (pid, src) not in dests and _index.exists(src):
+                if _verbose:
+                    PrintError("skipping " + entry.path,
+                               shortPath(src) + " exists")
+                continue
+            # the file was taken out of a cycle, whose other members were
+            # being moved along from the end; they have been up to the one
+            # free name in it, and the rest of the cycle is finished as a chain
+            chain = []
+            dest = dests.get((pid, src))
+            while dest is not None and dest not in chain and dest != src and \
+                  _index.exists(dest):
+                chain.append(dest)
+                dest = dests.get((pid, dest))
+            if dest is None or dest in chain or _index.exists(dest):
+                chain, dest = [], src
+            if chain:
+                dest = chain[0]
+            renames.append(Rename(entry.path, temp_path, path.basename(dest),
+                                  dest, entry))
+            for i, link in enumerate(chain):
+                next_link = chain[i+1] if i+1 < len(chain) else \
+                            dests[pid, link]
+                renames.append(Rename(link, link, path.basename(next_link),
+                                      next_link))
+        if renames:
+            processRenames(renames)
+
+def nextRename(arg, abspath, stat):
     dest = sys.stdin.readline()
     if not dest:
         PrintError(arg + " not renamed", "no input")
@@ -362,119 +1254,1418 @@ def nextRename(arg, abspath):
     dest = dest.rstrip('\n')
     if not dest:
         if _verbose:
-            print("skipping " + arg, "empty line", sep=': ')
+            PrintError("skipping " + arg, "empty line")
         return None
     else:
         dest = path.abspath(dest)
-        return Rename(arg, abspath, path.basename(dest), dest)
+        return Rename(arg, abspath, path.basename(dest), dest, stat)
+
+def readMapping(file, delimiter):
+    """Yield the (source, destination) pairs in a binary mapping file. With
+    a null delimiter, sources and destinations simply alternate; otherwise
+    each line is a source and a destination separated by a tab. Regular files
+    are memory-mapped and scanned in place, other files are read whole."""
+    import mmap
+    try:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, ValueError, OSError):
+        data = file.read()
+
+    start, lineno = 0, 0
+    while start < len(data):
+        end = data.find(delimiter, start)
+        if end < 0:
+            end = len(data)
+        if delimiter == b'\0':
+            src = data[start:end]
+            start = end + 1
+            end = data.find(delimiter, start)
+            if end < 0:
+                end = len(data)
+            dst = data[start:end]
+            if start >= len(data):
+                PrintError(os.fsdecode(src) + " not renamed", "no input")
+                updateStatus(1)
+                break
+        else:
+            src, tab, dst = data[start:end].partition(b'\t')
+            lineno += 1
+            if src and not tab:
+                PrintError("line %d" % lineno, "missing destination")
+                updateStatus(1)
+                src = None
+        start = end + 1
+        if src:
+            yield os.fsdecode(src), os.fsdecode(dst)
+
+    if isinstance(data, mmap.mmap):
+        data.close()
+
+def mapRenames(pairs):
+    renames = []
+    for arg, dest in pairs:
+        if not arg.rstrip(os.sep):
+            # "/" would otherwise become the current directory; see findFiles
+            PrintError(arg + " not renamed", "Cannot rename")
+            updateStatus(1)
+            continue
+        try:
+            addStat('stat calls')
+            stat = os.stat(arg)
+        except OSError as e:
+            PrintError(arg, e.strerror)
+            updateStatus(1)
+            continue
+
+        if not dest:
+            if _verbose:
+                PrintError("skipping " + arg, "no destination")
+            continue
+
+        dest = path.abspath(dest)
+        renames.append(Rename(arg, path.abspath(arg.rstrip(os.sep)),
+                              path.basename(dest), dest, stat))
+    return renames
+
+def parseFormat(format):
+    """Split a format string into a list of (literal, field, spec) parts, one
+    for each field, with the text before it; field is None in the last part.
+    Fields preceded by an odd number of backslashes are left as they are, as
+    are those with a spec where none is taken. The spec of a {hash} field is
+    split into the algorithm and the length, or None for the whole digest;
+    ValueError is raised for a bad spec."""
+    parts = []
+    last = 0
+    for match in _re_fmt_field.finditer(format):
+        field, spec = match.group('field', 'spec')
+        if spec is not None and field not in ('mtime', 'size', 'hash'):
+            continue
+        elif field == 'size' and spec:
+            int.__format__(0, spec)
+        elif field == 'hash':
+            spec = hashSpec(spec)
+        parts.append((format[last:match.end('pre')], field, spec))
+        last = match.end()
+    parts.append((format[last:], None, None))
+    return parts
+
+class Rules:
+    """How new names are made: the format, the transformations run on the
+    original name, and the numbering. Rules don't change once compiled, so
+    they can be shared between threads and reused for any number of plans."""
+
+    def __init__(self, format, transform, whole_name, lower_extension,
+                 initial, increment, zero_pad):
+        self.format = format
+        self.transform = transform
+        self.whole_name = whole_name
+        self.lower_extension = lower_extension
+        self.initial = initial
+        self.increment = increment
+        self.zero_pad = zero_pad
+        self.template = parseFormat(format)
+        fields = set(field for literal, field, spec in self.template)
+        self.numbered = 'N' in fields
+        self.named = '' in fields
+        self.needs_stat = not fields.isdisjoint(('mtime', 'size'))
+        self.hashes = tuple(sorted(set(spec[0] for literal, field, spec
+                                       in self.template if field == 'hash')))
+
+    def numberWidth(self, start, count):
+        """The width to pad numbers to for count files numbered from start,
+        or 0 for no padding."""
+        if not (self.zero_pad and self.numbered and count):
+            return 0
+        return len(str(start + self.increment * (count - 1)))
+
+    def newName(self, name, number=None, width=0, dirname='', stat=None,
+                digests=None):
+        """The new name for a file called name in directory dirname, numbered
+        number. stat is the file's stat result, or a function returning it;
+        it's only used if the format has a {mtime} or {size} field. If it has
+        a {hash} field, digests maps each algorithm in hashes to the hex
+        digest of the file, as given by hashFiles."""
+        if not self.whole_name:
+            name, ext = path.splitext(name)
+        else:
+            ext = path.splitext(name)[1]
+        if self.lower_extension:
+            ext = ext.lower()
+
+        if self.named:
+            if _stats_opt:
+                start = time.perf_counter()
+                name = self.transform.transform(name)
+                addStat('transform time', time.perf_counter() - start)
+            else:
+                name = self.transform.transform(name)
+        if self.needs_stat and callable(stat):
+            stat = stat()
+
+        parts = []
+        for literal, field, spec in self.template:
+            parts.append(literal)
+            if field is None:
+                continue
+            elif field == '':
+                parts.append(name)
+            elif field == 'N':
+                parts.append('%0*d' % (width, number))
+            elif field == 'mtime':
+                parts.append(time.strftime(spec or '%Y-%m-%d',
+                                           time.localtime(stat.st_mtime)))
+            elif field == 'size':
+                parts.append(format(stat.st_size, spec or ''))
+            elif field == 'parent':
+                parts.append(path.basename(dirname))
+            elif field == 'ext':
+                parts.append(ext[1:])
+            elif field == 'hash':
+                parts.append(digests[spec[0]][:spec[1]])
+        next_name = ''.join(parts)
+
+        if not self.whole_name:
+            next_name += ext
+        return next_name
+
+    def plan(self, paths, start=None, force=False, sort=None, reverse=False,
+             skip_duplicates=False):
+        """Work out the new names for paths, numbered from start (by default,
+        the initial index), check them for conflicts, and put them in order.
+        sort, reverse and skip_duplicates are as the options of the same
+        names. Returns a Plan, which is carried out by its execute method.
+        Files that can't be renamed are marked as failed, with the reason in
+        their error attribute, rather than reported."""
+        number = self.initial if start is None else start
+        state = {'_force': force, '_index': DirIndex(), '_quiet': True}
+        # only checking and planning need the engine state; finding, hashing
+        # and naming the files goes on alongside other plans
+        renames = findFiles((os.fspath(p) for p in paths), quiet=True)
+        nameRenames(self, [rn for rn in renames if not rn.failed], number,
+                    sort, reverse, skip_duplicates, state['_index'], True)
+        with engineState(**state):
+            plan = Plan(renames)
+        plan.state = state
+        return plan
+
+def compileRules(format=None, expressions=(), whole_name=False,
+                 lower_extension=False, initial=1, increment=1,
+                 zero_pad=False):
+    """Compile the rules for new names, as given by the corresponding command
+    line options; format defaults to "{}". Raises StringTransform.ParseError
+    for a bad expression, and ValueError for an empty format or a bad field
+    spec."""
+    libraryGlobals()
+    if format is None:
+        format = _fmt_name
+    if not format:
+        raise ValueError("empty format string")
+    transform = StringTransform()
+    for expr in expressions:
+        transform.addOperations(expr)
+    transform.compile()
+    return Rules(format, transform, whole_name, lower_extension,
+                 initial, increment, zero_pad)
+
+def findFiles(args, unique=True, quiet=False):
+    """A Rename for each of args, which are paths or the DirEntry objects of
+    a walk, with the file's stat result; with unique, only the first for each
+    path. The renames of files that can't be found are marked as failed, and
+    don't rename anything; unless quiet, they are also reported."""
+    renames = []
+    paths_seen = set()
+    for arg in args:
+        stat = None
+        if isinstance(arg, os.DirEntry):
+            stat, arg = arg, arg.path
+        abspath = path.abspath(arg.rstrip(os.sep) or arg)
+        if unique:
+            if abspath in paths_seen:
+                continue
+            paths_seen.add(abspath)
+        rn = Rename(arg, abspath, path.basename(abspath), abspath, stat)
+        renames.append(rn)
+        if not arg.rstrip(os.sep):
+            rn.fail("Cannot rename", quiet=quiet)
+            if not quiet:
+                updateStatus(1)
+            continue
+        if stat is None:
+            try:
+                addStat('stat calls')
+                rn.stat = os.stat(arg)
+            except OSError as e:
+                rn.fail(e.strerror, quiet=quiet)
+                if not quiet:
+                    updateStatus(1)
+    return renames
+
+def nameRenames(rules, renames, number, sort=None, reverse=False,
+                skip_duplicates=False, index=None, quiet=False):
+    """Give the renames of files found by findFiles their new names under
+    rules, numbered from number in the order given, or sorted by sort (see
+    sortRenames). Files that can't be hashed for a {hash} field are marked
+    as failed and aren't numbered. With skip_duplicates, files that have the
+    same digests as the file at their new name keep their names instead (see
+    skipDuplicates, which looks up existing files in index, by default the
+    engine's DirIndex). Failures are reported unless quiet. Returns the
+    renames that were given new names, and the number after the last."""
+    if sort:
+        with timed('sort'):
+            sortRenames(renames, sort, reverse)
+
+    digests = [None] * len(renames)
+    if rules.hashes:
+        with timed('hash'):
+            digests = hashFiles(renames, rules.hashes)
+    named = []
+    for rn, digest in zip(renames, digests):
+        if not isinstance(digest, OSError):
+            named.append((rn, digest))
+        elif _recursive and digest.errno == EISDIR:
+            # -R walks into the directories, but they have no digest
+            rn.failed = True
+        else:
+            rn.fail(digest.strerror, quiet=quiet)
+            if not quiet:
+                updateStatus(1)
+
+    width = rules.numberWidth(number, len(named))
+    for rn, digest in named:
+        dirname, name = path.split(rn.path)
+        rn.new_name = rules.newName(name, number, width, dirname,
+                                    rn.fileStat, digest)
+        rn.new_path = path.join(dirname, rn.new_name)
+        if rules.numbered:
+            number += rules.increment
+
+    if skip_duplicates:
+        renamed = skipDuplicates(named, index, quiet)
+    else:
+        renamed = [rn for rn, digest in named]
+    if _hash_cache:
+        # after skipDuplicates, which hashes the files already at the new names
+        _hash_cache.save()
+    return renamed, number
 
 def generateRenames(args):
     global _counter
+    renames = [rn for rn in findFiles(args, not _stdin) if not rn.failed]
+    if _stdin:
+        return [rn for rn in (nextRename(rn.arg, rn.path, rn.stat)
+                              for rn in renames) if rn]
+    renames, _counter = nameRenames(_rules, renames, _counter, _sort, _reverse,
+                                    _skip_duplicates)
+    return renames
 
-    pargs = tuple(arg.rstrip(os.sep) for arg in args)
-    if _zpad:
-        argslen = tuple(bool(s) for s in pargs).count(True)
-        maxlen = len(str(_counter + _increment * (argslen - 1)))
-        pf_number = '%0' + str(maxlen) + 'd'
+SORT_KEYS = ('name', 'natural', 'mtime', 'size')
+
+def sortRenames(renames, key, reverse=False):
+    """Sort renames in place by key, one of SORT_KEYS. Each file's key is
+    worked out once, and files are only stat'ed for "mtime" and "size" (and
+    then only if they haven't been already). Files with the same key are
+    kept in the order given."""
+    if key == 'name':
+        def sortKey(rn):
+            return rn.path
+    elif key == 'natural':
+        split = re.compile(r'(\d+)').split
+        def sortKey(rn):
+            parts = split(rn.path)
+            parts[0::2] = [part.casefold() for part in parts[0::2]]
+            parts[1::2] = map(int, parts[1::2])
+            return parts
+    elif key == 'mtime':
+        def sortKey(rn):
+            return rn.fileStat().st_mtime_ns
+    elif key == 'size':
+        def sortKey(rn):
+            return rn.fileStat().st_size
     else:
-        pf_number = '%d'
-
+        raise ValueError("unknown sort key: " + key)
+    renames.sort(key=sortKey, reverse=reverse)
+
+def hashSpec(spec):
+    """The hash algorithm and digest length given by the spec of a {hash}
+    field, "ALGO:LEN", where either may be left out."""
+    import hashlib
+    algorithm, sep, length = (spec or '').partition(':')
+    algorithm = algorithm.lower() or 'sha256'
+    if algorithm not in hashlib.algorithms_available or \
+       not hashlib.new(algorithm).digest_size:
+        raise ValueError("unsupported hash algorithm: " + algorithm)
+    if not length:
+        return algorithm, None
+    if not length.isdigit() or not int(length):
+        raise ValueError("invalid digest length: " + length)
+    return algorithm, int(length)
+
+def fileDigests(pathname, stat, algorithms):
+    """Map each of algorithms to the hex digest of the contents of a file, as
+    hashed by hashlib from memory mapped contents, or as found in the
+    --hash-cache. Raises OSError if the file can't be read."""
+    import hashlib, mmap
+    from stat import S_ISREG, S_ISDIR
+    if not S_ISREG(stat.st_mode):
+        if S_ISDIR(stat.st_mode):
+            raise OSError(EISDIR, os.strerror(EISDIR), pathname)
+        raise OSError(EINVAL, "Not a regular file", pathname)
+    key = (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    digests = {}
+    if _hash_cache:
+        for algorithm in algorithms:
+            digest = _hash_cache.get(key, algorithm)
+            if digest:
+                digests[algorithm] = digest
+    hashes = [hashlib.new(algorithm) for algorithm in algorithms
+              if algorithm not in digests]
+    if not hashes:
+        addStat('hash cache hits')
+        return digests
+
+    with open(pathname, 'rb') as file:
+        if stat.st_size:
+            # hashlib lets go of the GIL while it works through the pages
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for h in hashes:
+                    h.update(data)
+    addStat('files hashed')
+    addStat('bytes hashed', stat.st_size)
+    for h in hashes:
+        digests[h.name] = h.hexdigest()
+        if _hash_cache:
+            _hash_cache.add(key, h.name, digests[h.name])
+    return digests
+
+def hashFiles(renames, algorithms):
+    """The digests of the source files of renames, as returned by
+    fileDigests, or the OSError raised for each file that can't be read.
+    Files are hashed at the same time on a pool of threads."""
+    def digests(rn):
+        try:
+            return fileDigests(rn.path, rn.fileStat(), algorithms)
+        except OSError as e:
+            return e
+
+    if len(renames) < 2:
+        return [digests(rn) for rn in renames]
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(os.cpu_count() or 1) as pool:
+        return list(pool.map(digests, renames))
+
+def skipDuplicates(named, index=None, quiet=False):
+    """Leave out the renames, given with their digests, whose new names are
+    taken by a file with the same digests, be it one of the other files, or
+    a file that's already there and isn't being renamed, as found in index
+    (by default, the engine's). The files left out keep their names, and are
+    noted with -v unless quiet."""
+    if index is None:
+        index = _index
+    sources = set(rn.path for rn, digest in named)
+    claimed = dict((rn.new_path, (rn, digest)) for rn, digest in named
+                   if rn.path == rn.new_path)
     renames = []
-    paths_seen = set()
+    for rn, digest in named:
+        if rn.path != rn.new_path:
+            other = claimed.get(rn.new_path)
+            if other is not None:
+                duplicate, other = other[1] == digest, other[0].path
+            elif rn.new_path not in sources and index.exists(rn.new_path):
+                other = rn.new_path
+                try:
+                    addStat('stat calls')
+                    duplicate = fileDigests(other, os.stat(other),
+                                            list(digest)) == digest
+                except OSError:
+                    duplicate = False
+            else:
+                duplicate = False
+            if duplicate:
+                addStat('duplicates skipped')
+                if _verbose and not quiet:
+                    PrintError(rn.arg, "same digest as " + shortPath(other))
+                rn.new_name, rn.new_path = path.basename(rn.path), rn.path
+                continue
+            claimed.setdefault(rn.new_path, (rn, digest))
+        renames.append(rn)
+    return renames
 
-    for i, arg in enumerate(pargs):
-        if not arg:
-            PrintError(args[i], "Cannot rename")
-            updateStatus(1)
-            continue
+class HashCache:
+    """The digests of files hashed by earlier runs, kept in the --hash-cache
+    file with a line for each, so that files aren't hashed again until they
+    change. Files are known by device, inode, size and modification time,
+    none of which are changed by renaming them."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.digests = {}
+        self.added = []
+        self.lock = Lock()
+        try:
+            with open(filename, 'rb') as file:
+                for line in file:
+                    fields = line.split()
+                    if len(fields) != 6:
+                        continue
+                    try:
+                        key = tuple(int(field) for field in fields[:4])
+                    except ValueError:
+                        continue
+                    self.digests[key + (fields[4].decode(),)] = \
+                        fields[5].decode()
+        except FileNotFoundError:
+            pass
 
+    def get(self, key, algorithm):
+        with self.lock:
+            return self.digests.get(key + (algorithm,))
+
+    def add(self, key, algorithm, digest):
+        with self.lock:
+            self.digests[key + (algorithm,)] = digest
+            self.added.append(b'%d %d %d %d %s %s\n' % (key + (
+                              algorithm.encode(), digest.encode())))
+
+    def save(self):
+        """Add the digests computed since the last save to the file, in one
+        write, so that the lines of runs sharing the file aren't mixed."""
+        with self.lock:
+            lines, self.added = self.added, []
+        if not lines:
+            return
         try:
-            os.stat(args[i])
+            fd = os.open(self.filename,
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+            try:
+                os.write(fd, b''.join(lines))
+            finally:
+                os.close(fd)
         except OSError as e:
-            PrintError(args[i], e.strerror)
+            PrintError(self.filename, e.strerror)
             updateStatus(1)
-            continue
 
-        abspath = path.abspath(arg)
 
-        if _stdin:
-            rn = nextRename(args[i], abspath)
-            if rn:
-                renames.append(rn)
+def checkConflicts(renames, deferred=None):
+    """Find the renames that are bound to fail before any file is touched:
+    destinations claimed more than once, destinations that differ only in
+    case, and destinations that exist and won't be vacated by the rest of
+    the renames. Each conflict is reported, and the offending rename is
+    marked as failed so that it is skipped. Returns the number of conflicts.
+
+    If a deferred list is given, renames whose destinations exist are put on
+    it instead of being reported, as are the renames that depend on them."""
+    sources = {}
+    claimed = {}
+    folded = {}
+    conflicts = []
+
+    def foldKey(pathname):
+        dirname, name = path.split(pathname)
+        return dirname, name.casefold()
+
+    def conflict(rn, reason, deferrable=False):
+        if deferrable and deferred is not None:
+            rn.failed = True
+            deferred.append(rn)
+            conflicts.append((rn, True))
+        else:
+            conflicts.append((rn, False))
+            rn.fail(reason)
+            updateStatus(1)
+
+    for rn in renames:
+        if rn.path == rn.new_path:
+            claimed.setdefault(rn.path, rn)
+            folded.setdefault(foldKey(rn.path), rn)
+        elif rn.path not in sources:
+            sources[rn.path] = rn
+
+    for rn in renames:
+        if rn.path == rn.new_path or rn.failed:
             continue
+        other = claimed.get(rn.new_path)
+        if other is not None:
+            if other.path == other.new_path:
+                conflict(rn, shortPath(rn.new_path) + " exists")
+            else:
+                conflict(rn, shortPath(rn.new_path) +
+                             " is also the destination of " + other.arg)
+            continue
+        other = folded.get(foldKey(rn.new_path))
+        if other is not None:
+            conflict(rn, shortPath(rn.new_path) + " differs only in case from "
+                         + shortPath(other.new_path))
+            continue
+        if foldKey(rn.path) == foldKey(rn.new_path) and \
+           sameFile(rn.path, rn.new_path):
+            # a change of case where names are looked up without regard to
+            # case: the destination is the source itself, and is moved out
+            # of its own way through a temporary name
+            rn.hop = True
+        elif rn.new_path not in sources and not _force and \
+           _index.exists(rn.new_path):
+            conflict(rn, shortPath(rn.new_path) + " exists", True)
+            continue
+        claimed[rn.new_path] = rn
+        folded[foldKey(rn.new_path)] = rn
+
+    # a skipped rename keeps its source occupied, which in turn blocks any
+    # rename that was counting on it being vacated
+    i = 0
+    while i < len(conflicts):
+        rn, was_deferred = conflicts[i]
+        i += 1
+        if sources.get(rn.path) is not rn:
+            continue
+        for other in (claimed.get(rn.path), folded.get(foldKey(rn.path))):
+            if other is not None and not other.failed and \
+               other.path != other.new_path:
+                conflict(other, shortPath(other.new_path) + " exists",
+                         was_deferred)
+
+    return sum(1 for rn, was_deferred in conflicts if not was_deferred)
 
-        if abspath in paths_seen:
+def sameFile(pathname, other):
+    """Whether two paths name the same file."""
+    try:
+        addStat('stat calls', 2)
+        info, other_info = os.lstat(pathname), os.lstat(other)
+    except OSError:
+        return False
+    return (info.st_dev, info.st_ino) == (other_info.st_dev, other_info.st_ino)
+
+def planRenames(renames):
+    """Order renames so that each destination is vacated before it is filled.
+
+    Every rename is an edge from its source to its destination; since sources
+    are unique, following the edges from any rename gives a chain that either
+    ends at a free destination or runs into a cycle. Chains are renamed
+    directly, last link first, and a cycle is broken by moving only one of its
+    members to a temporary name, as is a change of case that the file system
+    takes for no change (see checkConflicts). Returns a list of independent
+    groups, each a list of (step, argument) pairs to be run in order, where
+    step is Rename.doRename or Rename.exchange on a rename, or rotateCycle on
+    a list of renames."""
+    global _sources
+    _sources = {}
+    for rn in renames:
+        if rn.path != rn.new_path and not rn.failed and \
+           rn.path not in _sources:
+            _sources[rn.path] = rn
+
+    groups = []
+    group_of = {}
+    for rn in _sources.values():
+        if rn.path in group_of:
             continue
+        chain = []
+        on_chain = {}
+        node = rn
+        while node is not None and node.path not in group_of \
+                               and node.path not in on_chain:
+            on_chain[node.path] = len(chain)
+            chain.append(node)
+            node = _sources.get(node.new_path)
+
+        if node is None or node.path in on_chain:
+            group = []
+            groups.append(group)
         else:
-            paths_seen.add(abspath)
+            group = group_of[node.path]
+        for link in chain:
+            group_of[link.path] = group
+
+        if node is not None and node.path in on_chain:
+            cycle = chain[on_chain[node.path]:]
+            del chain[on_chain[node.path]:]
+            if len(cycle) == 2 and renameat2():
+                group.append((Rename.exchange, cycle[0]))
+            else:
+                _stats['temp hops'] += 1
+                group.append((rotateCycle, cycle))
+        for link in reversed(chain):
+            if link.hop:
+                _stats['temp hops'] += 1
+                group.append((rotateCycle, [link]))
+            else:
+                group.append((Rename.doRename, link))
+
+    for rn in renames:
+        if rn.path != rn.new_path and not rn.failed and \
+           _sources[rn.path] is not rn:
+            groups.append([(Rename.doRename, rn)])
+
+    _stats['planned'] += len(_sources)
+    return groups
+
+class Plan:
+    """A set of renames, checked for conflicts and put in order, ready to be
+    carried out; see checkConflicts and planRenames. The renames that were
+    found to conflict are marked as failed, and conflicts is their number."""
+
+    def __init__(self, renames, deferred=None):
+        self.renames = renames
+        self.state = None
+        with timed('check'):
+            self.conflicts = checkConflicts(renames, deferred)
+        with timed('plan'):
+            self.groups = planRenames(renames)
+        self.sources = _sources
+
+    def execute(self, jobs=1):
+        """Carry out the renames, and return the ones that were made. A plan
+        made by Rules.plan runs on up to jobs threads, like --jobs, and is
+        rolled back if interrupted."""
+        if self.state is None:
+            self.run()
+        else:
+            with engineState(_jobs=jobs, _sources=self.sources, **self.state):
+                try:
+                    self.run()
+                finally:
+                    while _transactions:
+                        _transactions[-1].rollback()
+                    closeDirFds()
+        return [rn for rn in self.renames if rn.renamed]
+
+    def run(self):
+        global _sources
+        if not self.groups:
+            return
+        _sources = self.sources
+        if _journal:
+            moves = [rn for rn in self.renames
+                     if rn.path != rn.new_path and not rn.failed]
+            batch = _journal.begin(moves)
+        try:
+            with timed('rename'):
+                runPlan(self.groups)
+        finally:
+            if _journal:
+                # an interrupted cycle is put back before the outcome of the
+                # batch is recorded
+                while _transactions:
+                    _transactions[-1].rollback()
+                _journal.end(batch, moves)
+
+class engineState:
+    """Set the globals that the renaming functions work with for the length
+    of a with block. Library calls go through here, one thread at a time,
+    each with state of its own."""
+
+    def __init__(self, **state):
+        self.state = state
+
+    def __enter__(self):
+        _engine_lock.acquire()
+        self.saved = {name: globals()[name] for name in self.state}
+        globals().update(self.state)
+
+    def __exit__(self, *exc_info):
+        globals().update(self.saved)
+        _engine_lock.release()
+
+def libraryGlobals():
+    """Set up the globals for use as a library, the first time through; main
+    sets them up itself."""
+    global __prog__
+    global _lock
+    global _stats_opt
+    global _force
+    global _jobs
+    global _verbose
+    global _recursive
+    with _setup_lock:
+        if '_index' in globals():
+            return
+        __prog__ = path.basename(__file__)
+        _lock = Lock()
+        _stats_opt = False
+        _force = False
+        _jobs = 1
+        _verbose = False
+        _recursive = False
+        updateStatus(0)
+        instantiateGlobals()
 
-        dirname, name = path.split(abspath)
-        if not _wname:
-            name, ext = path.splitext(name)
+def processRenames(renames, defer=False):
+    """Check, plan and carry out one set of renames, and print the results.
+    With defer, returns the renames that were held back because their
+    destinations exist; see checkConflicts."""
+    deferred = [] if defer else None
+    plan = Plan(renames, deferred)
+    if plan.conflicts and _abort:
+        raise Exit(1, "%d conflict%s found" % (plan.conflicts,
+                                              's' if plan.conflicts > 1 else ''),
+                      "no files renamed")
+
+    if not _noact:
+        plan.execute()
+
+    with timed('print'):
+        for rn in renames: rn.print()
+        _output.flush()
+        sys.stderr.flush()
+
+    for rn in deferred or ():
+        rn.failed = False
+    return deferred
+
+def runGroup(group):
+    for step, arg in group:
+        step(arg)
+
+def runPlan(plan):
+    """Carry out the groups of a plan. With --jobs, groups are taken in turn
+    by a pool of threads; since no group depends on another, only the order
+    within each group matters, which a single thread preserves. On
+    interruption no more groups are started, and the ones running are allowed
+    to finish so that their transactions can be rolled back."""
+    if _jobs <= 1 or len(plan) <= 1:
+        for group in plan:
+            runGroup(group)
+        return
 
-        if _do_fmt_number:
-            next_name = _re_fmt_number.sub(r'\g<pre>' + (pf_number % _counter),
-                                           _format)
-            _counter += _increment
-        else:
-            next_name = _format
+    from threading import Thread
+    groups = iter(plan)
+    lock = Lock()
+    stop = False
+    errors = []
 
-        if _do_fmt_name:
-            name = _transform.transform(name).replace('\\', r'\\')
-            next_name = _re_fmt_name.sub(r'\g<pre>' + name, next_name)
+    def worker():
+        try:
+            while not stop:
+                with lock:
+                    group = next(groups, None)
+                if group is None:
+                    return
+                runGroup(group)
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [Thread(target=worker) for i in range(min(_jobs, len(plan)))]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    finally:
+        stop = True
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+def processBatches(batches, carry=False, generate=None, restart=False):
+    """Rename each batch of arguments in turn, numbering continuously unless
+    restart is true. With carry, a rename whose destination exists is held
+    back, along with the renames waiting on it, in case a following batch
+    moves that file out of the way; it is retried only with a batch that
+    does, and once more at the end. Each batch is turned into renames by
+    generate, by default generateRenames."""
+    global _counter
+    waiting = {}
+    for args in batches:
+        if restart:
+            _counter = _initial
+        with timed('generate'):
+            renames = (generate or generateRenames)(args)
+
+        ready = []
+        sources = [rn.path for rn in renames]
+        while sources:
+            for rn in waiting.pop(sources.pop(), ()):
+                ready.append(rn)
+                sources.append(rn.path)
+        for rn in processRenames(ready + renames, carry) or ():
+            waiting.setdefault(rn.new_path, []).append(rn)
+    if waiting:
+        processRenames([rn for held in waiting.values() for rn in held])
+
+def selectedName(name):
+    return not (_exclude and _exclude.match(name)) and \
+           (not _include or _include.match(name))
+
+def isWalkable(arg):
+    top = arg.rstrip(os.sep) or arg
+    return path.isdir(top) and not path.islink(top)
+
+def listDir(dirpath, report=True):
+    addStat('directory scans')
+    try:
+        with os.scandir(dirpath) as it:
+            return sorted(it, key=lambda entry: entry.name)
+    except OSError as e:
+        if report:
+            PrintError(dirpath, e.strerror)
+            updateStatus(1)
+        return None
 
-        if not _wname:
-            next_name += (ext.lower() if _lower else ext)
+def walkTree(top, report=True):
+    """Yield the contents of directory top one directory at a time, deepest
+    first, so that every file is renamed before the directory that contains
+    it. Entries are filtered by the --include and --exclude patterns, and
+    excluded directories are not descended into."""
+    stack = [(top, None)]
+    while stack:
+        dirpath, entries = stack[-1]
+        if entries is None:
+            entries = listDir(dirpath, report)
+            if entries is None:
+                stack.pop()
+                continue
+            stack[-1] = (dirpath, entries)
+            for entry in reversed(entries):
+                if entry.is_dir(follow_symlinks=False) and \
+                   not (_exclude and _exclude.match(entry.name)):
+                    stack.append((entry.path, None))
+            continue
+        stack.pop()
+        batch = [entry for entry in entries if selectedName(entry.name)]
+        if batch:
+            yield batch
+
+def walkBatches(args):
+    """Yield the batches of walkTree for each directory among args, then
+    args themselves."""
+    for arg in args:
+        if isWalkable(arg):
+            yield from walkTree(arg)
+    yield [arg for arg in args
+               if selectedName(path.basename(path.abspath(arg.rstrip(os.sep))))]
 
-        renames.append(Rename(args[i], abspath, next_name, path.join(dirname, next_name)))
+def countTree(top):
+    return sum(len(batch) for batch in walkTree(top, False))
 
-    return renames
+def runShard(shard):
+    """Rename everything inside the directory shard, numbering from start,
+    in a worker process; see runShards."""
+    global _counter
+    top, start = shard
+    _counter = start
+    signals = ("SIGINT", "SIGHUP", "SIGTERM")
+    saved_handlers = {}
+    for signame in signals:
+        signum = getattr(signal, signame, None)
+        if signum:
+            saved_handlers[signum] = signal.signal(signum, handler)
+    interrupted = None
+    try:
+        processBatches(walkTree(top), restart=_per_dir)
+    except Exit as e:
+        PrintError(*e.args)
+        updateStatus(e.status)
+        if e.status in saved_handlers:
+            interrupted = e.status
+    finally:
+        while _transactions:
+            _transactions[-1].rollback()
+        closeDirFds()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for signum in saved_handlers:
+            signal.signal(signum, saved_handlers[signum])
+        _results.put(('done', _status, _num_errors, collectStats()))
+    if interrupted:
+        # the parent is terminating the pool; die of the signal once the
+        # results are through
+        _results.close()
+        _results.join_thread()
+        signal.signal(interrupted, signal.SIG_DFL)
+        os.kill(os.getpid(), interrupted)
+
+def initWorker(argv, results):
+    global __prog__
+    global _lock
+    global _results
+    global _journal
+    __prog__ = path.basename(argv[0])
+    _lock = Lock()
+    _results = results
+    updateStatus(0)
+    instantiateGlobals()
+    parseOptions(argv)
+    if _journal_file and not _noact:
+        _journal = Journal(_journal_file)
+    sys.stdout = QueueWriter(results, 'out')
+    sys.stderr = QueueWriter(results, 'err')
+    # between shards, leave interrupts to the parent and let it terminate us
+    for signame, action in (("SIGINT", signal.SIG_IGN),
+                            ("SIGHUP", signal.SIG_DFL),
+                            ("SIGTERM", signal.SIG_DFL)):
+        signum = getattr(signal, signame, None)
+        if signum:
+            signal.signal(signum, action)
+
+class QueueWriter:
+    """Stand-in for a worker's standard output or error, which passes on what
+    is written to it through a queue in large pieces. Bytes go through
+    buffer, as with a real text stream."""
+
+    def __init__(self, queue, name, binary=False):
+        self.queue = queue
+        self.name = name
+        self.pieces = []
+        self.size = 0
+        self.binary = binary
+        if not binary:
+            self.buffer = QueueWriter(queue, name + '.buffer', True)
+
+    def write(self, data):
+        self.pieces.append(data)
+        self.size += len(data)
+        if self.size >= 1 << 16:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.pieces:
+            empty = b'' if self.binary else ''
+            self.queue.put((self.name, empty.join(self.pieces)))
+            self.pieces = []
+            self.size = 0
+        if not self.binary:
+            self.buffer.flush()
+
+def runShards(args, argv):
+    """Rename the directories among args with a pool of processes. Each
+    subdirectory of those directories is a shard, renamed inside by one
+    worker, with output and status sent back here as it comes; the
+    subdirectories themselves and the other contents of the directories are
+    then renamed here, followed by args. For continuous numbering, the
+    entries in each shard are counted first, and each is numbered from where
+    the previous one leaves off, in the same order as without sharding."""
+    global _counter
+    import multiprocessing
+    from queue import Empty
+
+    segments = []
+    for arg in args:
+        if not isWalkable(arg):
+            continue
+        entries = listDir(arg)
+        if entries is None:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False) and \
+               not (_exclude and _exclude.match(entry.name)):
+                segments.append((entry.path, None))
+        segments.append((arg, [entry for entry in entries
+                                     if selectedName(entry.name)]))
+    shards = [top for top, batch in segments if batch is None]
+
+    results = multiprocessing.Queue()
+    with multiprocessing.Pool(_processes, initWorker, (argv, results)) as pool:
+        starts = {}
+        if _rules.numbered and not _per_dir:
+            counts = dict(zip(shards, pool.map(countTree, shards)))
+            for top, batch in segments:
+                starts[top] = _counter
+                _counter += _increment * (len(batch) if batch is not None
+                                                     else counts[top])
+        done = pool.map_async(runShard, [(top, starts.get(top, _counter))
+                                         for top in shards])
+        remaining = len(shards)
+        while remaining:
+            try:
+                message = results.get(timeout=0.1)
+            except Empty:
+                if done.ready() and not done.successful():
+                    done.get()
+                continue
+            if message[0] == 'out':
+                sys.stdout.write(message[1])
+            elif message[0] == 'out.buffer':
+                sys.stdout.flush()
+                sys.stdout.buffer.write(message[1])
+            elif message[0] == 'err':
+                sys.stderr.write(message[1])
+            else:
+                status, num_errors, stats = message[1:]
+                mergeStatus(status, num_errors)
+                with _lock:
+                    _stats.update(stats)
+                remaining -= 1
+        sys.stdout.flush()
+        pool.close()
+        pool.join()
+
+    for top, batch in segments:
+        if batch is not None:
+            _counter = starts.get(top, _counter)
+            processBatches([batch], restart=_per_dir)
+    processBatches([[arg for arg in args
+                       if selectedName(path.basename(
+                              path.abspath(arg.rstrip(os.sep))))]],
+                   restart=_per_dir)
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+
+WATCH_DELAY = 0.1
+WATCH_MAX_DELAY = 1.0
+POLL_INTERVAL = 1.0
+
+class Inotify:
+    """The names of the files written or moved into a directory, as reported
+    by inotify(7). Raises OSError where inotify isn't available."""
+
+    def __init__(self, dirpath):
+        if not sys.platform.startswith('linux'):
+            raise OSError(ENOSYS, os.strerror(ENOSYS))
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            init, add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except (ImportError, OSError, AttributeError):
+            raise OSError(ENOSYS, os.strerror(ENOSYS))
+        add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.dirpath = dirpath
+        self.fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        if add_watch(self.fd, os.fsencode(dirpath),
+                     IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE_SELF |
+                     IN_MOVE_SELF) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, os.strerror(errno), dirpath)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        os.close(self.fd)
+
+    def wait(self, timeout=None):
+        """The names of the files that arrive within timeout seconds (or
+        however long it takes, if None), after the first of them."""
+        from select import select
+        from struct import unpack_from
+        if not select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        names = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = unpack_from('iIII', data, offset)
+            name = data[offset+16:offset+16+length].rstrip(b'\0')
+            offset += 16 + length
+            if mask & IN_Q_OVERFLOW:
+                PrintError(self.dirpath, "too many files at once; some of "
+                                         "them may not be renamed")
+                updateStatus(1)
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                raise Exit(1, self.dirpath, "no longer there to watch")
+            elif name and not mask & IN_ISDIR:
+                names.append(os.fsdecode(name))
+        return names
+
+class DirPoller:
+    """Stand-in for Inotify, which scans the directory every POLL_INTERVAL
+    seconds. A new file is taken to have arrived once its size and
+    modification time are the same in two scans running; only new files are
+    stat'ed."""
+
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+        self.known = self.scan()
+        self.pending = {}
+        self.next_scan = time.monotonic() + POLL_INTERVAL
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def scan(self):
+        addStat('directory scans')
+        try:
+            with os.scandir(self.dirpath) as it:
+                return set(entry.name for entry in it)
+        except OSError as e:
+            raise Exit(1, self.dirpath, e.strerror)
+
+    def wait(self, timeout=None):
+        from stat import S_ISDIR
+        now = time.monotonic()
+        if timeout is not None and now + timeout < self.next_scan:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(0, self.next_scan - now))
+        self.next_scan = time.monotonic() + POLL_INTERVAL
+
+        names = self.scan()
+        self.known &= names
+        arrived = []
+        for name in sorted(names - self.known):
+            try:
+                addStat('stat calls')
+                stat = os.stat(path.join(self.dirpath, name))
+            except OSError:
+                continue
+            key = (stat.st_size, stat.st_mtime_ns)
+            if S_ISDIR(stat.st_mode):
+                self.known.add(name)
+            elif self.pending.get(name) == key:
+                self.known.add(name)
+                arrived.append(name)
+            else:
+                self.pending[name] = key
+        for name in list(self.pending):
+            if name in self.known or name not in names:
+                del self.pending[name]
+        return arrived
+
+def watchBatches(watcher):
+    """Yield the names of the files that arrive, as reported by watcher, in
+    batches: once no more have arrived for WATCH_DELAY seconds, or it's been
+    WATCH_MAX_DELAY seconds since the first, or BATCH_SIZE have arrived."""
+    batch = {}
+    first = last = None
+    while True:
+        timeout = None
+        if batch:
+            timeout = min(last + WATCH_DELAY,
+                          first + WATCH_MAX_DELAY) - time.monotonic()
+            if timeout <= 0 or len(batch) >= BATCH_SIZE:
+                yield list(batch)
+                batch = {}
+                continue
+        names = watcher.wait(timeout)
+        if names:
+            last = time.monotonic()
+            if not batch:
+                first = last
+            batch.update(dict.fromkeys(names))
+
+def watchDir(dirpath):
+    """Rename the files written or moved into directory dirpath as they
+    arrive, a batch at a time, until interrupted. Files that are gone by the
+    time their batch comes up are passed over, as are the files moved into
+    dirpath by the renames themselves. With --state, the next index is saved
+    after every batch."""
+    global _index
+    dirpath = path.abspath(dirpath)
+    if not path.isdir(dirpath):
+        raise Exit(1, dirpath, os.strerror(ENOTDIR))
+    try:
+        watcher = Inotify(dirpath)
+    except OSError:
+        watcher = DirPoller(dirpath)
+
+    own = set()
+    with watcher:
+        for batch in watchBatches(watcher):
+            args = []
+            for name in batch:
+                if name in own:
+                    own.discard(name)
+                elif selectedName(name):
+                    addStat('lexists calls')
+                    if path.lexists(path.join(dirpath, name)):
+                        args.append(path.join(dirpath, name))
+            if not args:
+                continue
+            # files arrive between batches, so no listing of a directory can
+            # be kept from one batch to the next
+            _index = DirIndex()
+            with timed('generate'):
+                renames = generateRenames(args)
+            processRenames(renames)
+            for rn in renames:
+                dirname, name = path.split(rn.new_path)
+                if rn.renamed and dirname == dirpath:
+                    own.add(name)
+            if _state_fd is not None:
+                try:
+                    storeState()
+                except OSError as e:
+                    PrintError(_state_file, e.strerror)
+                    updateStatus(1)
+
+def compileGlobs(patterns):
+    if not patterns:
+        return None
+    from fnmatch import translate
+    return re.compile('|'.join(translate(pattern) for pattern in patterns))
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def readPaths(file, delimiter):
+    """Yield the delimiter-terminated paths in a binary file, reading it in
+    large blocks. Empty items are skipped."""
+    rest = b''
+    while True:
+        block = file.read(1 << 16)
+        if not block:
+            break
+        items = (rest + block).split(delimiter)
+        rest = items.pop()
+        for item in items:
+            if item:
+                yield os.fsdecode(item)
+    if rest:
+        yield os.fsdecode(rest)
+
+def collectStats():
+    stats = _stats.copy()
+    if hasattr(_rules.transform.func, 'cache_info'):
+        stats['transform cache hits'] += _rules.transform.func.cache_info().hits
+    return stats
+
+STAT_COUNTERS = ('renamed', 'temp hops', 'temp hops avoided', 'temp retries',
+                 'rollbacks', 'rolled back', 'stat calls', 'lexists calls',
+                 'directory scans', 'transform cache hits',
+                 'cross-device moves', 'bytes copied', 'files hashed',
+                 'bytes hashed', 'hash cache hits', 'duplicates skipped')
+STAT_TIMERS = ('generate', 'transform', 'hash', 'sort', 'check', 'plan',
+               'rename', 'print', 'total')
+
+def printStats(as_json=False):
+    """Print the counters and the time spent in each phase, in seconds, to
+    standard error. The transform time is part of the generate time. With
+    -P, times are summed over the processes."""
+    stats = collectStats()
+    stats['temp hops avoided'] = stats['planned'] - stats['temp hops']
+    if as_json:
+        import json
+        print(json.dumps({
+            'counters': {key: stats[key] for key in STAT_COUNTERS},
+            'times': {key: round(stats[key + ' time'], 6)
+                      for key in STAT_TIMERS},
+        }), file=sys.stderr)
+        return
+    for key in STAT_COUNTERS:
+        PrintError(key, str(stats[key]))
+    for key in STAT_TIMERS:
+        PrintError(key + ' time', '%.3fs' % stats[key + ' time'])
+
+class timed:
+    """Add the time spent in a with block to the total for phase."""
 
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        addStat(self.phase + ' time', time.perf_counter() - self.start)
+
+
+def addStat(key, n=1):
+    with _lock:
+        _stats[key] += n
+
+def mergeStatus(status, num_errors):
+    global _status, _num_errors
+    with _lock:
+        _status = max(_status, status)
+        _num_errors += num_errors
 
 def updateStatus(code):
     global _status, _num_errors
-    if code == 0:
-        _status = 0
-        _num_errors = 0
-    else:
-        _status = max(_status, code)
-        _num_errors += 1
+    with _lock:
+        if code == 0:
+            _status = 0
+            _num_errors = 0
+        else:
+            _status = max(_status, code)
+            _num_errors += 1
 
 def instantiateGlobals():
     global _pid
     global _letters
-    global _renamed
+    global _transactions
+    global _sources
+    global _stats
+    global _renameat2
+    global _dirfds
+    global _flagless_devices
+    global _index
+    global _journal
+    global _quiet
+    global _engine_lock
+    global _state_fd
+    global _hash_cache
     _pid = os.getpid()
     _letters = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
-    _renamed = {}
+    _transactions = []
+    _sources = {}
+    from collections import Counter
+    _stats = Counter()
+    _renameat2 = False
+    _dirfds = DirFds()
+    _flagless_devices = set()
+    _index = DirIndex()
+    _journal = None
+    _quiet = False
+    _engine_lock = RLock()
+    _state_fd = None
+    _hash_cache = None
 
     global _fmt_number
     global _fmt_name
-    global _re_fmt_number
-    global _re_fmt_name
-    global _re_home
+    global _re_fmt_field
     _fmt_number = '{N}'
     _fmt_name = '{}'
     not_escaped = r'(?P<pre>(?:^|(?<=[^\\]))(?:\\\\)*)'
-    _re_fmt_number = re.compile(not_escaped + _fmt_number)
-    _re_fmt_name = re.compile(not_escaped + _fmt_name)
-    _re_home = re.compile(r'^' + path.expanduser('~'))
+    _re_fmt_field = re.compile(not_escaped + r'\{(?P<field>N|mtime|size|parent'
+                               r'|ext|hash|)(?::(?P<spec>[^{}]*))?\}')
 
 def parseOptions(argv):
     global __usage__
+    global _abort
     global _force
     global _verbose
     global _noact
+    global _output
+    global _stats_opt
+    global _stats_json
+    global _profile
+    global _jobs
     global _stdin
-    global _wname
-    global _lower
-    global _format
-    global _do_fmt_name
-    global _do_fmt_number
-    global _transform
+    global _from_file
+    global _map_file
+    global _journal_file
+    global _state_file
+    global _undo_file
+    global _recover
+    global _delimiter
+    global _rules
     global _counter
+    global _initial
     global _increment
     global _zpad
+    global _recursive
+    global _per_dir
+    global _include
+    global _processes
+    global _exclude
+    global _skip_duplicates
+    global _hash_cache
+    global _sort
+    global _reverse
+    global _watch
 
     number = "num" in __prog__
 
@@ -485,8 +2676,8 @@ def parseOptions(argv):
         def exit(self, status=0, msg=None):
             raise Exit(status, msg)
     try:
-        __usage__ = ( "Usage: %s [-fvn]  [-r]  [-wl] [-s FORMAT] [-e EXPR]...\n"
-                      "       %s [-i N] [-j N] [-z]  [FILE]..."
+        __usage__ = ( "Usage: %s [-afvn] [-r]  [-wl] [-s FORMAT] [-e EXPR]...\n"
+                      "       %s [-i N] [-j N] [-zd] [-R] [FILE]..."
                       % (__prog__, len(__prog__)*' ') )
         parser = OptParser(prog=__prog__, version="%prog "+__version__,
                            usage=__usage__, add_help_option=False)
@@ -494,18 +2685,89 @@ def parseOptions(argv):
                           help='show this help message and exit')
         parser.add_option("-?", "--usage", default=False, action="store_true",
                           help='show a brief usage string and exit')
+        parser.add_option("-a", "--abort", default=False, action="store_true",
+                          help='rename nothing if any conflicts are found '
+                               '(by default, only the conflicting files are '
+                               'skipped)')
         parser.add_option("-f", "--force", default=False, action="store_true",
                           help='overwrite existing files')
         parser.add_option("-v", "--verbose", default=False, action="store_true",
                           help='print names of files successfully renamed')
         parser.add_option("-n", "--no-act", default=False, action="store_true",
                           help='only show which files would be renamed')
+        parser.add_option("--jobs", metavar="N", default=1, type="int",
+                          help='rename up to N independent groups of files at '
+                               'a time, each on its own thread; this helps on '
+                               'network file systems, where every rename waits '
+                               'on the server (default is %default)')
+        parser.add_option("--print0", default=False, action="store_true",
+                          help='print each file renamed (with -n, to be '
+                               'renamed) and its new path, each followed by a '
+                               'null character, as read by --map -0')
+        parser.add_option("--json", default=False, action="store_true",
+                          help='print a JSON object for each file on a line of '
+                               'its own, with its "old" and "new" paths, '
+                               '"status" ("renamed", "failed", "planned" with '
+                               '-n, or "not renamed" if interrupted) and '
+                               '"error" (the reason it failed, or null)')
+        parser.add_option("--stats", default=False, action="store_true",
+                          help='print a summary of the renames done, with '
+                               'counts of the system calls made and the time '
+                               'taken by each phase, to standard error')
+        parser.add_option("--stats-json", default=False, action="store_true",
+                          help='like --stats, but print the summary as a '
+                               'JSON object')
+        parser.add_option("--profile", metavar="FILE",
+                          help='run under cProfile and save the profile to '
+                               'FILE, for the pstats module ("-" to print '
+                               'the most expensive calls to standard error '
+                               'instead)')
+        parser.add_option("--journal", metavar="FILE",
+                          help='before each batch of files is renamed, add a '
+                               'record of the renames to FILE, so that they can '
+                               'be undone later with --undo')
+        parser.add_option("--undo", metavar="JOURNAL",
+                          help='undo the renames recorded in JOURNAL, latest '
+                               'first; FILE arguments and the renaming options '
+                               'below are not used')
+        parser.add_option("--recover", default=False, action="store_true",
+                          help='put back the files left at temporary names '
+                               'in the directories given (with -R, also in '
+                               'their subdirectories) by runs that were '
+                               'killed; with --journal, the journal of those '
+                               'runs is read, and each file is moved on to '
+                               'its intended name instead where that is free. '
+                               'The renaming options below are not used')
         parser.add_option("-r", "--stdin", default=False, action="store_true",
                           help='read destination paths verbatim from standard '
                                'input, one per line, and match them up with the '
                                'command-line arguments (all the renaming options '
                                'below will be ignored); an empty line means to '
                                'skip the corresponding argument')
+        parser.add_option("--map", metavar="FILE",
+                          help='rename files as listed in FILE ("-" for '
+                               'standard input), where each line has a file '
+                               'and its destination path separated by a tab '
+                               '(with -0, the two simply alternate, each '
+                               'terminated by a null character); FILE '
+                               'arguments and the renaming options below are '
+                               'not used')
+        parser.add_option("--from-file", metavar="FILE",
+                          help='also read the files to rename from FILE ("-" '
+                               'for standard input), one per line; they are '
+                               'renamed in batches as they are read, so any '
+                               'number of files can be given')
+        parser.add_option("--watch", metavar="DIR",
+                          help='keep running, and rename each file written '
+                               'or moved into DIR shortly after it arrives, '
+                               'until interrupted; the files already there are '
+                               'left alone, and FILE arguments are not used. '
+                               'With --state, numbering carries on after a '
+                               'restart')
+        parser.add_option("-0", "--null", default=False, action="store_true",
+                          help='names read with --from-file or --map are '
+                               'terminated by a null character instead of a '
+                               'newline')
         parser.add_option("-w", "--whole-name", default=False, action="store_true",
                           help='change the entire name (by default, any file '
                                'suffix is automatically preserved)')
@@ -520,9 +2782,20 @@ def parseOptions(argv):
                           help='format string for new names, in which "' +
                                _fmt_name + '" is replaced by the original file '
                                'name and "' + _fmt_number + '" by an incremental '
-                               'number (see "Numbering" below); for example, '
-                               '--format="' + _fmt_number + '-' + _fmt_name + '" '
-                               'or -s "00{N}" (the default is "%default")')
+                               'number (see "Numbering" below); "{mtime:FMT}" '
+                               'by the time the file was last modified, as '
+                               'formatted by strftime(3) (FMT is "%Y-%m-%d" if '
+                               'left out), "{size}" by its size in bytes, '
+                               '"{parent}" by the name of its directory, '
+                               '"{ext}" by its extension, without the dot, and '
+                               '"{hash:ALGO:LEN}" by the first LEN characters '
+                               'of the hex digest of its contents, where ALGO '
+                               'is any algorithm of the hashlib module (all of '
+                               'a sha256 digest if both are left out; see '
+                               '"Hashing" below). For '
+                               'example, --format="' + _fmt_number + '-' +
+                               _fmt_name + '" or -s "{mtime:%Y%m%d}-{N}" (the '
+                               'default is "%default")')
         parser.add_option("-e", "--expression", metavar="EXPR",
                           default=[], action="append",
                           help='one or more semicolon-separated transformations '
@@ -549,6 +2822,64 @@ def parseOptions(argv):
                                'negative (default is %default)')
         group.add_option("-z", "--zero-pad", default=False, action="store_true",
                           help='use leading zeros to pad numbers')
+        group.add_option("--sort", metavar="KEY", type="choice",
+                          choices=SORT_KEYS,
+                          help='number the files in order of KEY rather than '
+                               'in the order given: "name" (their paths, '
+                               'character by character), "natural" (their '
+                               'paths, with runs of digits compared as '
+                               'numbers, as by ls -v), "mtime" (oldest first) '
+                               'or "size" (smallest first). With --from-file, '
+                               'all the files are read before any is renamed; '
+                               'with -R, the files in each directory are '
+                               'sorted separately')
+        group.add_option("--reverse", default=False, action="store_true",
+                          help='with --sort, number the files in reverse '
+                               'order')
+        group.add_option("--state", metavar="FILE",
+                          help='carry on numbering from where the last run '
+                               'given the same FILE left off, and save where '
+                               'this one leaves off in FILE, so that the '
+                               'batches of files that xargs(1) or find -exec '
+                               'pass are numbered as one; runs that share FILE '
+                               'wait for each other')
+        group.add_option("-d", "--per-directory", default=False,
+                          action="store_true",
+                          help='with -R, number the files in each directory '
+                               'separately, starting from the initial index')
+        parser.add_option_group(group)
+        group = OptionGroup(parser, "Hashing")
+        group.add_option("--skip-duplicates", default=False,
+                         action="store_true",
+                         help='leave a file alone if its new name is taken by '
+                              'a file with the same digest, either one given '
+                              'before it or one that is already there, rather '
+                              'than report a conflict')
+        group.add_option("--hash-cache", metavar="FILE",
+                         help='keep the digests of the files hashed in FILE, '
+                              'and use those already there for files that '
+                              'haven\'t changed since, going by their device, '
+                              'inode, size and modification time')
+        parser.add_option_group(group)
+        group = OptionGroup(parser, "Directories")
+        group.add_option("-R", "--recursive", default=False, action="store_true",
+                          help='also rename everything inside the directories '
+                               'given, one directory at a time; the contents '
+                               'of a directory are renamed before the '
+                               'directory itself')
+        group.add_option("-P", "--processes", metavar="N", default=1,
+                          type="int",
+                          help='with -R, share the work out among N '
+                               'processes, one subdirectory of each directory '
+                               'given at a time (default is %default)')
+        group.add_option("--include", metavar="GLOB", default=[],
+                          action="append",
+                          help='with -R, only rename files whose names match '
+                               'GLOB; may be given more than once')
+        group.add_option("--exclude", metavar="GLOB", default=[],
+                          action="append",
+                          help='with -R, skip files and directories whose '
+                               'names match GLOB; may be given more than once')
         parser.add_option_group(group)
         opts, args = parser.parse_args(argv[1:])
 
@@ -565,30 +2896,114 @@ def parseOptions(argv):
             parser.print_usage()
             raise Exit(0, None)
 
+        _abort = opts.abort
         _force = opts.force
         _verbose = opts.verbose
         _noact = opts.no_act
+        if opts.print0 and opts.json:
+            raise OptParseError("--print0 can't be used with --json")
+        _output = OutputWriter('json' if opts.json else
+                               'print0' if opts.print0 else 'text')
+        _stats_opt = opts.stats or opts.stats_json
+        _stats_json = opts.stats_json
+        _profile = opts.profile
+        _jobs = opts.jobs
         _stdin = opts.stdin
-        _wname = opts.whole_name
-        _lower = opts.lower_extension
-
-        _format = opts.format
-        if not _format:
-            raise OptParseError("empty format string")
-
-        _do_fmt_name = bool(_re_fmt_name.search(_format))
-        _do_fmt_number = bool(_re_fmt_number.search(_format))
-
-        _transform = StringTransform()
-        for expr in opts.expression:
-            try:
-                _transform.addOperations(expr)
-            except StringTransform.ParseError as e:
-                raise OptParseError(': '.join(e.args))
-
-        _counter = opts.initial
+        _from_file = opts.from_file
+        _map_file = opts.map
+        _journal_file = opts.journal
+        _state_file = opts.state
+        _undo_file = opts.undo
+        _recover = opts.recover
+        _delimiter = b'\0' if opts.null else b'\n'
+        try:
+            _rules = compileRules(opts.format, opts.expression,
+                                  opts.whole_name, opts.lower_extension,
+                                  opts.initial, opts.increment, opts.zero_pad)
+        except StringTransform.ParseError as e:
+            raise OptParseError(': '.join(e.args))
+        except ValueError as e:
+            raise OptParseError(str(e))
+
+        _counter = _initial = opts.initial
         _increment = opts.increment
         _zpad = opts.zero_pad
+        _recursive = opts.recursive
+        _per_dir = opts.per_directory
+        _include = compileGlobs(opts.include)
+        _processes = opts.processes
+        _exclude = compileGlobs(opts.exclude)
+        _skip_duplicates = opts.skip_duplicates
+        _sort = opts.sort
+        _reverse = opts.reverse
+        _watch = opts.watch
+        if opts.hash_cache:
+            try:
+                _hash_cache = HashCache(opts.hash_cache)
+            except OSError as e:
+                raise Exit(1, opts.hash_cache, e.strerror)
+
+        if _recursive:
+            if _map_file or _from_file or _stdin:
+                raise OptParseError("-R can't be used with --map, --from-file "
+                                    "or -r")
+            if _zpad and not _per_dir:
+                raise OptParseError("-z can't be used with -R unless "
+                                    "numbering with -d")
+            if _abort:
+                raise OptParseError("-a can't be used with -R")
+
+        if _sort and (_stdin or _map_file):
+            raise OptParseError("--sort can't be used with -r or --map")
+        if _reverse and not _sort:
+            raise OptParseError("--reverse can't be used without --sort")
+
+        if _skip_duplicates and not _rules.hashes:
+            raise OptParseError("--skip-duplicates can't be used without "
+                                "{hash} in FORMAT")
+
+        if _state_file:
+            if _zpad:
+                raise OptParseError("-z can't be used with --state")
+            if _per_dir:
+                raise OptParseError("-d can't be used with --state")
+
+        if _watch:
+            if args or _recover or _undo_file or _map_file or _from_file or \
+               _stdin or _recursive:
+                raise OptParseError("--watch can't be used with FILE "
+                                    "arguments, --recover, --undo, --map, "
+                                    "--from-file, -r or -R")
+            if _abort:
+                raise OptParseError("-a can't be used with --watch")
+            if _zpad:
+                raise OptParseError("-z can't be used with --watch")
+
+        if _recover:
+            if _undo_file or _map_file or _from_file or _stdin:
+                raise OptParseError("--recover can't be used with --undo, "
+                                    "--map, --from-file or -r")
+            if _abort:
+                raise OptParseError("-a can't be used with --recover")
+        elif _undo_file:
+            if args or _map_file or _from_file or _stdin or _recursive:
+                raise OptParseError("--undo can't be used with FILE arguments, "
+                                    "--map, --from-file, -r or -R")
+            if _abort:
+                raise OptParseError("-a can't be used with --undo")
+        elif _map_file:
+            if args or _from_file or _stdin:
+                raise OptParseError("--map can't be used with FILE arguments, "
+                                    "--from-file or -r")
+            if _abort:
+                raise OptParseError("-a can't be used with --map")
+        elif _from_file:
+            if _zpad:
+                raise OptParseError("-z can't be used with --from-file")
+            if _abort:
+                raise OptParseError("-a can't be used with --from-file")
+            if _stdin and _from_file == '-':
+                raise OptParseError("-r can't be used with --from-file=-")
 
         return args
 
@@ -596,6 +3011,102 @@ def parseOptions(argv):
         parser.print_usage(file=sys.stderr)
         raise Exit(2, e.msg)
 
+def loadState(filename):
+    """Lock the --state file, waiting for any other run that has it, and
+    carry on the numbering from the index saved in it."""
+    global _counter
+    global _state_fd
+    import fcntl
+    try:
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o666)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        data = os.read(fd, 64).strip()
+    except OSError as e:
+        raise Exit(1, filename, e.strerror)
+    if data:
+        try:
+            _counter = int(data)
+        except ValueError:
+            os.close(fd)
+            raise Exit(1, filename, "not a state file")
+    _state_fd = fd
+
+def storeState():
+    """Write the next index to the --state file, unless nothing is renamed
+    for real."""
+    if not _noact:
+        os.lseek(_state_fd, 0, os.SEEK_SET)
+        os.ftruncate(_state_fd, 0)
+        os.write(_state_fd, b'%d\n' % _counter)
+
+def saveState():
+    """Save the next index to the --state file, unless nothing was renamed
+    for real, and unlock it."""
+    global _state_fd
+    try:
+        storeState()
+    except OSError as e:
+        PrintError(_state_file, e.strerror)
+        updateStatus(1)
+    finally:
+        os.close(_state_fd)
+        _state_fd = None
+
+def renameArgs(args, argv):
+    """Rename the files given, as the options say."""
+    if _watch:
+        watchDir(_watch)
+    elif _recover:
+        recoverRenames(args or [os.curdir])
+    elif _undo_file:
+        undoJournal(_undo_file)
+    elif _map_file:
+        try:
+            if _map_file == '-':
+                file = sys.stdin.buffer
+            else:
+                file = open(_map_file, 'rb')
+        except OSError as e:
+            raise Exit(1, _map_file, e.strerror)
+        with file:
+            processBatches(chunked(readMapping(file, _delimiter),
+                                   BATCH_SIZE), True, mapRenames)
+    elif _recursive:
+        if _processes > 1:
+            runShards(args, argv)
+        else:
+            processBatches(walkBatches(args), restart=_per_dir)
+    elif _from_file:
+        try:
+            if _from_file == '-':
+                file = sys.stdin.buffer
+            else:
+                file = open(_from_file, 'rb')
+        except OSError as e:
+            raise Exit(1, _from_file, e.strerror)
+        with file:
+            from itertools import chain
+            paths = chain(args, readPaths(file, _delimiter))
+            if _sort:
+                # none can be numbered until the last one has been read
+                processBatches([list(paths)], True)
+            else:
+                processBatches(chunked(paths, BATCH_SIZE), True)
+    else:
+        processBatches([args])
+
+def saveProfile(profiler):
+    if _profile == '-':
+        import pstats
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats(
+            'cumulative').print_stats(30)
+        return
+    try:
+        profiler.dump_stats(_profile)
+    except OSError as e:
+        PrintError(_profile, e.strerror)
+        updateStatus(1)
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv
@@ -610,17 +3121,35 @@ def main(argv=None):
         global __prog__
         __prog__ = path.basename(argv[0])
 
+        global _lock
+        _lock = Lock()
         updateStatus(0)
         instantiateGlobals()
 
-        global _queue
-        _queue = generateRenames(parseOptions(argv))
-
-        if not _noact:
-            for rn in _queue: rn.tempMove()
-            for rn in _queue: rn.doRename()
-
-        for rn in _queue: rn.print()
+        args = parseOptions(argv)
+        if _journal_file and not _noact and not _recover:
+            global _journal
+            try:
+                _journal = Journal(_journal_file)
+            except OSError as e:
+                raise Exit(1, _journal_file, e.strerror)
+        if _state_file:
+            loadState(_state_file)
+
+        start = time.perf_counter()
+        if _profile:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            renameArgs(args, argv)
+        finally:
+            if _profile:
+                profiler.disable()
+                saveProfile(profiler)
+            addStat('total time', time.perf_counter() - start)
+
+        if _stats_opt: printStats(_stats_json)
         return _status
 
     except Exit as e:
@@ -629,11 +3158,17 @@ def main(argv=None):
 
     finally:
         try:
-            for rn in _queue:
-                rn.tempRevert()
+            while _transactions:
+                _transactions[-1].rollback()
         except NameError:
             pass
 
+        closeDirFds()
+        if _journal:
+            _journal.close()
+        if _state_fd is not None:
+            saveState()
+
         for signum in saved_handlers:
             signal.signal(signum, saved_handlers[signum])
 